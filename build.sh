@@ -1,6 +1,7 @@
 #! /bin/sh
+# the context is the repo root so every image copies `common/` in too
 for name in link_crawler downloader validator kline_pusher; do 
-    docker buildx build $PWD/$name \
+    docker buildx build $PWD \
         --push \
         --platform linux/arm64,linux/amd64 \
         --tag docker.kube.home/apps/binance-crawler/$name \
@@ -0,0 +1,3 @@
+'''Modules shared by link_crawler, downloader, validator and kline_pusher,
+copied into every image next to the tool's own modules
+'''
@@ -0,0 +1,199 @@
+'''Retries and the adaptive concurrency of the http fetches of downloader
+and kline_pusher's pipeline
+'''
+from __future__ import annotations
+import asyncio
+import datetime as dt
+import email.utils
+import os
+import random
+import time
+import logging
+import logging.config
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+from urllib.parse import urlparse
+
+import aiohttp
+import aiofiles
+import aiofiles.os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+CHECKSUM_SUFFIX = '.CHECKSUM'
+CHUNK_SIZE = 2**18
+TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class ChecksumError(Exception):
+    '''A file doesn't match its `.CHECKSUM`
+    '''
+
+
+def is_transient(e: BaseException) -> bool:
+    '''Throttling, server errors, dropped connections, timeouts and incomplete
+    payloads are worth retrying and are signs of congestion, the other 4xx
+    responses and local errors are not
+    '''
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in TRANSIENT_STATUS
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def is_retryable(e: BaseException) -> bool:
+    '''A checksum mismatch is retried too, without counting as congestion
+    '''
+    return is_transient(e) or isinstance(e, ChecksumError)
+
+
+async def fetch_checksum(sess: aiohttp.ClientSession,
+                         url: str,
+                         download_dir: Path | None = None) -> str:
+    '''It reads the sha256 of `url` from its `.CHECKSUM` sibling,
+    preferring a copy that is already downloaded in `download_dir`
+    '''
+    fname = urlparse(url).path.split('/')[-1] + CHECKSUM_SUFFIX
+    fpath = Path(os.path.join(download_dir, fname)) if download_dir else None
+    if fpath and await aiofiles.os.path.exists(fpath):
+        async with aiofiles.open(fpath, mode='r') as f:
+            resp = await f.read()
+    else:
+        async with sess.get(url + CHECKSUM_SUFFIX) as resp:
+            resp.raise_for_status()
+            resp = await resp.text()
+    return resp.split()[0]
+
+
+def get_retry_after(e: BaseException) -> float | None:
+    '''It reads `Retry-After` in seconds or as a http-date
+    '''
+    headers = getattr(e, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0., (date - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+def get_backoff(attempt: int, base: float = 1, cap: float = 60) -> float:
+    '''Exponential backoff with full jitter
+    '''
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class Controller:
+    '''AIMD controller of the number of downloads in flight
+
+    The limit grows by one per window of successful downloads and is halved,
+    at most once per `cooldown`, on a transient error or when the time to
+    the first byte rises over `latency_tolerance` times its baseline.
+    `Retry-After` pauses every new download until it has passed.
+    '''
+
+    def __init__(self,
+                 max_limit: int,
+                 min_limit: int = 1,
+                 initial: int | None = None,
+                 latency_tolerance: float = 3,
+                 cooldown: float = 2) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial or max(min_limit, max_limit // 4))
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.latency: float | None = None
+        self.base_latency: float | None = None
+        self.pause_until = 0.
+        self.decreased_at = 0.
+        self.cond = asyncio.Condition()
+
+    async def __aenter__(self) -> Controller:
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.on_success()
+        elif is_transient(exc):
+            self.on_error(get_retry_after(exc))
+        await self.release()
+
+    async def acquire(self):
+        async with self.cond:
+            while True:
+                delay = self.pause_until - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self.cond.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    await self.cond.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_error(self, retry_after: float | None = None):
+        now = time.monotonic()
+        if retry_after:
+            self.pause_until = max(self.pause_until, now + retry_after)
+            logger.info(f'===== Pause downloads for {retry_after:.1f} sec =====')
+        self.decrease(now)
+
+    def on_latency(self, latency: float):
+        self.latency = latency if self.latency is None else \
+                       0.8 * self.latency + 0.2 * latency
+        if self.base_latency is None:
+            self.base_latency = self.latency
+        # the baseline drifts up slowly so a lasting shift is accepted
+        self.base_latency = min(self.base_latency * 1.001, self.latency)
+        threshold = max(self.latency_tolerance * self.base_latency,
+                        self.base_latency + 0.1)
+        if self.latency > threshold:
+            self.decrease(time.monotonic())
+
+    def decrease(self, now: float):
+        if now - self.decreased_at < self.cooldown:
+            return
+        self.decreased_at = now
+        self.limit = max(self.min_limit, self.limit / 2)
+        logger.info(f'===== Concurrency is decreased to {int(self.limit)} =====')
+
+
+def ttfb_trace_config(*observers: Callable[[float], None]) -> aiohttp.TraceConfig:
+    '''It measures the time to the response headers of every request once
+    and passes it to every observer, e.g. the controller and the metrics
+    '''
+
+    async def on_request_start(sess: aiohttp.ClientSession,
+                               ctx: SimpleNamespace,
+                               params: aiohttp.TraceRequestStartParams):
+        ctx.start = time.monotonic()
+
+    async def on_request_end(sess: aiohttp.ClientSession,
+                             ctx: SimpleNamespace,
+                             params: aiohttp.TraceRequestEndParams):
+        ttfb = time.monotonic() - ctx.start
+        for observe in observers:
+            observe(ttfb)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
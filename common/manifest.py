@@ -0,0 +1,154 @@
+'''SQLite manifest of the artifacts shared by link_crawler, downloader, validator
+and kline_pusher
+
+It is a module of the `common` package, which every tool image copies in at
+build time from the root of the repository.
+'''
+from __future__ import annotations
+import dataclasses as dc
+import sqlite3
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import urlparse
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifact (
+    url TEXT PRIMARY KEY,
+    fname TEXT NOT NULL,
+    size INTEGER,
+    last_modified TEXT,
+    etag TEXT,
+    sha256 TEXT,
+    fpath TEXT,
+    status TEXT NOT NULL DEFAULT 'listed',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifact_status ON artifact (status);
+CREATE INDEX IF NOT EXISTS artifact_fname ON artifact (fname);
+'''
+
+
+class Status(str, Enum):
+    LISTED = 'listed'
+    DOWNLOADING = 'downloading'
+    DOWNLOADED = 'downloaded'
+    VALID = 'valid'
+    FAILED = 'failed'
+    INGESTED = 'ingested'
+
+
+@dc.dataclass
+class Artifact:
+    url: str
+    size: int | None = None
+    last_modified: str | None = None
+    etag: str | None = None
+    sha256: str | None = None
+    fpath: str | None = None
+    status: Status = Status.LISTED
+    attempts: int = 0
+    failures: int = 0
+
+    def __post_init__(self):
+        self.status = Status(self.status)
+
+    @property
+    def fname(self) -> str:
+        return urlparse(self.url).path.split('/')[-1]
+
+
+class Manifest:
+    '''One row per artifact, every update is a transaction of its own
+    '''
+    columns = [field.name for field in dc.fields(Artifact)]
+
+    def __init__(self, fpath: Path | str) -> None:
+        self.conn = sqlite3.connect(fpath, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def __enter__(self) -> Manifest:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def upsert(self, artifacts: Iterable[Artifact]) -> int:
+        '''It inserts listed artifacts, a changed size, last-modified or etag
+        means the artifact was republished so it is listed again.
+        Unknown values keep what is already recorded
+        '''
+        stmt = '''
+        INSERT INTO artifact (url, fname, size, last_modified, etag, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (url) DO UPDATE SET
+            status = CASE
+                WHEN excluded.size IS NOT NULL
+                     AND excluded.size IS NOT artifact.size THEN 'listed'
+                WHEN excluded.last_modified IS NOT NULL
+                     AND excluded.last_modified IS NOT artifact.last_modified
+                     THEN 'listed'
+                WHEN excluded.etag IS NOT NULL
+                     AND excluded.etag IS NOT artifact.etag THEN 'listed'
+                ELSE artifact.status END,
+            size = COALESCE(excluded.size, artifact.size),
+            last_modified = COALESCE(excluded.last_modified,
+                                     artifact.last_modified),
+            etag = COALESCE(excluded.etag, artifact.etag),
+            updated_at = excluded.updated_at
+        '''
+        now = time.time()
+        rows = [(a.url, a.fname, a.size, a.last_modified, a.etag, now)
+                for a in artifacts]
+        with self.conn:
+            self.conn.executemany(stmt, rows)
+        return len(rows)
+
+    def select(self, *statuses: Status) -> list[Artifact]:
+        stmt = f'SELECT {", ".join(self.columns)} FROM artifact'
+        if statuses:
+            stmt += f' WHERE status IN ({", ".join("?" * len(statuses))})'
+        rows = self.conn.execute(stmt + ' ORDER BY url',
+                                 [status.value for status in statuses])
+        return [Artifact(*row) for row in rows]
+
+    def select_by_fname(self, fname: str) -> Artifact | None:
+        stmt = f'SELECT {", ".join(self.columns)} FROM artifact WHERE fname = ?'
+        row = self.conn.execute(stmt, (fname, )).fetchone()
+        return Artifact(*row) if row else None
+
+    def update(self,
+               url: str,
+               status: Status,
+               attempt: bool = False,
+               failure: bool = False,
+               **values):
+        '''It sets the status of an artifact with any other column in `values`
+        and counts a download attempt or a validation failure
+        '''
+        values = {'status': Status(status).value, **values}
+        assign = [f'{column} = ?' for column in values]
+        assign.append(f'attempts = attempts + {int(attempt)}')
+        assign.append(f'failures = failures + {int(failure)}')
+        assign.append('updated_at = ?')
+        stmt = f'UPDATE artifact SET {", ".join(assign)} WHERE url = ?'
+        with self.conn:
+            self.conn.execute(stmt, [*values.values(), time.time(), url])
+
+    def update_by_fname(self, fname: str, status: Status, **values):
+        artifact = self.select_by_fname(fname)
+        if artifact:
+            self.update(artifact.url, status, **values)
+
+    def count(self) -> dict[Status, int]:
+        stmt = 'SELECT status, COUNT(*) FROM artifact GROUP BY status'
+        return {Status(status): cnt for status, cnt in self.conn.execute(stmt)}
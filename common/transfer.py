@@ -0,0 +1,89 @@
+'''Resumable streaming of a file into its `.part` file with ranged requests,
+shared by downloader and kline_pusher's pipeline
+'''
+from __future__ import annotations
+import hashlib
+from pathlib import Path
+from typing import Callable
+
+import aiohttp
+import aiofiles
+import aiofiles.os
+
+from common.controller import CHUNK_SIZE
+from common.writer import WriteConfig
+
+PART_SUFFIX = '.part'
+OnChunk = Callable[[bytes], None]
+
+
+def get_part_fpath(fpath: Path) -> Path:
+    return fpath.with_name(fpath.name + PART_SUFFIX)
+
+
+def get_total_size(resp: aiohttp.ClientResponse, offset: int) -> int | None:
+    '''It returns the full size of a file from `Content-Range` or `Content-Length`
+    '''
+    content_range = resp.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.split('/')[-1]
+        return int(total) if total != '*' else None
+    if resp.content_length is not None:
+        return offset + resp.content_length
+    return None
+
+
+async def hash_file(fpath: Path, hasher: hashlib._Hash, chunk_size: int = 2**20):
+    async with aiofiles.open(fpath, mode='rb') as f:
+        while data := await f.read(chunk_size):
+            hasher.update(data)
+
+
+async def stream_to_part(sess: aiohttp.ClientSession,
+                         url: str,
+                         part_fpath: Path,
+                         chunk_size: int = CHUNK_SIZE,
+                         hasher: hashlib._Hash | None = None,
+                         on_chunk: OnChunk | None = None,
+                         write_config: WriteConfig | None = None) -> int:
+    '''It streams a file into `part_fpath`, resuming from the bytes on disk,
+    and checks that every byte has arrived
+    '''
+    write_config = write_config or WriteConfig()
+    offset = 0
+    if await aiofiles.os.path.exists(part_fpath):
+        offset = await aiofiles.os.path.getsize(part_fpath)
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    async with sess.get(url, headers=headers) as resp:
+        if resp.status == 416:  # the part file may already be complete
+            fsize = get_total_size(resp, offset)
+            if fsize != offset:
+                await aiofiles.os.remove(part_fpath)
+                raise aiohttp.ClientPayloadError(
+                    f'{part_fpath.name} is larger than the source')
+            if hasher:
+                await hash_file(part_fpath, hasher)
+        else:
+            resp.raise_for_status()
+            if resp.status != 206:  # the server ignored the range request
+                offset = 0
+            if hasher and offset:
+                await hash_file(part_fpath, hasher)
+            fsize = get_total_size(resp, offset)
+            mode = 'ab' if offset else 'wb'
+            async with write_config.open(part_fpath, mode) as writer:
+                if fsize is not None:
+                    await writer.allocate(offset, fsize - offset)
+                async for data in resp.content.iter_chunked(chunk_size):
+                    if hasher:
+                        hasher.update(data)
+                    if on_chunk:
+                        on_chunk(data)
+                    await writer.write(data)
+
+    size = await aiofiles.os.path.getsize(part_fpath)
+    if fsize is not None and size != fsize:
+        raise aiohttp.ClientPayloadError(
+            f'{part_fpath.name} is incomplete {size}/{fsize} bytes')
+    return size
@@ -0,0 +1,117 @@
+from __future__ import annotations
+import asyncio
+import ctypes
+import ctypes.util
+import dataclasses as dc
+import os
+from pathlib import Path
+
+import aiofiles
+
+FALLOC_FL_KEEP_SIZE = 0x01
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64
+    ]
+except (OSError, AttributeError, TypeError):  # not linux
+    _fallocate = None
+
+
+def preallocate(fd: int, offset: int, length: int) -> bool:
+    '''It reserves disk blocks without changing the file size,
+    so the size of a `.part` file is still the number of bytes written
+    '''
+    if not _fallocate or length <= 0:
+        return False
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class AiofilesWriter:
+    '''Every chunk is a write of its own in the aiofiles thread pool
+    '''
+
+    def __init__(self, config: WriteConfig, fpath: Path, mode: str) -> None:
+        self.config = config
+        self.fpath = fpath
+        self.mode = mode
+        self.f = None
+
+    async def __aenter__(self) -> AiofilesWriter:
+        self.f = await aiofiles.open(self.fpath, mode=self.mode)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.f.close()
+
+    async def allocate(self, offset: int, length: int):
+        if self.config.preallocate:
+            preallocate(self.f.fileno(), offset, length)
+
+    async def write(self, data: bytes):
+        await self.f.write(data)
+
+
+class BufferedWriter:
+    '''Chunks are coalesced into `buffer_size` buffers, a full buffer is written
+    in a thread while the next one is filled
+    '''
+
+    def __init__(self, config: WriteConfig, fpath: Path, mode: str) -> None:
+        self.config = config
+        self.fpath = fpath
+        self.mode = mode
+        self.buffer = bytearray()
+        self.pending: asyncio.Future | None = None
+        self.f = None
+
+    async def __aenter__(self) -> BufferedWriter:
+        loop = asyncio.get_running_loop()
+        self.f = await loop.run_in_executor(None, open, self.fpath, self.mode)
+        return self
+
+    async def __aexit__(self, *args):
+        try:
+            await self.flush()
+            if self.pending:
+                await self.pending
+        finally:
+            self.f.close()
+
+    async def allocate(self, offset: int, length: int):
+        if self.config.preallocate:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, preallocate, self.f.fileno(),
+                                       offset, length)
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.config.buffer_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        if self.pending:
+            await self.pending
+        data, self.buffer = self.buffer, bytearray()
+        loop = asyncio.get_running_loop()
+        self.pending = loop.run_in_executor(None, self.f.write, data)
+
+
+WRITERS = {
+    'aiofiles': AiofilesWriter,
+    'buffered': BufferedWriter,
+}
+
+
+@dc.dataclass
+class WriteConfig:
+    strategy: str = 'buffered'
+    buffer_size: int = 2**20
+    preallocate: bool = False
+
+    def open(self, fpath: Path, mode: str) -> AiofilesWriter | BufferedWriter:
+        return WRITERS[self.strategy](self, fpath, mode)
@@ -0,0 +1,184 @@
+'''Local benchmark of the download write path
+
+It serves synthetic zip files with tools/stub_server.py and downloads them
+with every write strategy, so the disk path is measured without the network.
+
+>>> python bench.py --files 32 --size 64 --limit 16 --output bench.json
+'''
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+import logging
+import logging.config
+
+import aiohttp
+
+from main import asynchronous_download, create_connector, CHUNK_SIZE
+from common.writer import WriteConfig, WRITERS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+STUB_SERVER = Path(__file__).resolve().parent.parent / 'tools' / 'stub_server.py'
+
+
+def create_corpus(root: Path, n_files: int, size: int) -> list[str]:
+    '''It writes stored (uncompressed) zip files of random bytes
+    '''
+    keys = []
+    for idx in range(n_files):
+        key = f'bench/BENCH-1m-{idx:04d}.zip'
+        fpath = Path(root, key)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(fpath, mode='w',
+                             compression=zipfile.ZIP_STORED) as zf:
+            zf.writestr(fpath.stem + '.csv', os.urandom(size))
+        keys.append(key)
+    return keys
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    until = time.monotonic() + timeout
+    while time.monotonic() < until:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'stub server is not up on {port}')
+
+
+async def run_case(urls: list[str], download_dir: Path, limit: int,
+                   chunk_size: int, write_config: WriteConfig) -> dict:
+    shutil.rmtree(download_dir, ignore_errors=True)
+    download_dir.mkdir(parents=True)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def download(sess: aiohttp.ClientSession, url: str) -> float:
+        async with semaphore:
+            fpath = Path(download_dir, os.path.basename(url))
+            return await asynchronous_download(sess, url, fpath, chunk_size,
+                                               write_config=write_config)
+
+    started_at, cpu_started_at = time.perf_counter(), time.process_time()
+    async with aiohttp.ClientSession(
+            connector=create_connector(limit, limit)) as sess:
+        sizes = await asyncio.gather(*[download(sess, url) for url in urls])
+    elapsed = time.perf_counter() - started_at
+    cpu_sec = time.process_time() - cpu_started_at
+
+    mib, gib = sum(sizes) / 2**20, sum(sizes) / 2**30
+    return {
+        'strategy': write_config.strategy,
+        'buffer_size': write_config.buffer_size,
+        'preallocate': write_config.preallocate,
+        'chunk_size': chunk_size,
+        'files': len(urls),
+        'mib': round(mib, 1),
+        'elapsed_sec': round(elapsed, 3),
+        'mib_per_sec': round(mib / elapsed, 1),
+        'cpu_sec_per_gib': round(cpu_sec / gib, 3),
+    }
+
+
+def main(n_files: int,
+         size: int,
+         limit: int,
+         chunk_size: int,
+         buffer_size: int,
+         repeat: int = 3,
+         output: Path | None = None) -> list[dict]:
+    tmp_dir = Path(tempfile.mkdtemp(prefix='bench-'))
+    server = None
+    try:
+        keys = create_corpus(tmp_dir / 'bucket', n_files, size)
+        port = get_free_port()
+        cmd = [
+            sys.executable,
+            str(STUB_SERVER),
+            str(tmp_dir / 'bucket'), '--port',
+            str(port)
+        ]
+        server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        wait_for_port(port)
+        urls = [f'http://127.0.0.1:{port}/{key}' for key in keys]
+
+        configs = [
+            WriteConfig(strategy, buffer_size, preallocate)
+            for strategy in WRITERS for preallocate in [False, True]
+        ]
+        # a warm-up round so the page cache of the corpus doesn't favour
+        # whichever strategy runs second
+        asyncio.run(
+            run_case(urls, tmp_dir / 'download', limit, chunk_size,
+                     configs[0]))
+        results = []
+        for config in configs:
+            runs = [
+                asyncio.run(
+                    run_case(urls, tmp_dir / 'download', limit, chunk_size,
+                             config)) for _ in range(repeat)
+            ]
+            # the median run by throughput
+            result = sorted(runs, key=lambda x: x['mib_per_sec'])[repeat // 2]
+            logger.info(json.dumps(result))
+            results.append(result)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if output:
+        with open(output, mode='w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the write path of the downloader')
+    parser.add_argument('--files', '-n', type=int, default=32)
+    parser.add_argument('--size',
+                        '-s',
+                        type=int,
+                        default=32,
+                        help='MiB of every file')
+    parser.add_argument('--limit', '-l', type=int, default=16)
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=CHUNK_SIZE // 1024,
+                        help='KiB read from the socket at a time')
+    parser.add_argument('--buffer_size',
+                        type=float,
+                        default=1,
+                        help='MiB coalesced by the buffered writer')
+    parser.add_argument('--repeat',
+                        '-r',
+                        type=int,
+                        default=3,
+                        help='runs of every case, the median is reported')
+    parser.add_argument('--output', '-o', type=Path, help='json report')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args.files, args.size * 2**20, args.limit, args.chunk_size * 1024,
+         int(args.buffer_size * 2**20), args.repeat, args.output)
@@ -1,6 +1,9 @@
 from __future__ import annotations
 import argparse
+import dataclasses as dc
 import os
+import hashlib
+import json
 import asyncio
 from pathlib import Path
 from urllib.parse import urlparse
@@ -12,6 +15,14 @@ import aiohttp
 import aiofiles
 import aiofiles.os
 
+from common.controller import (Controller, ChecksumError, is_retryable,
+                               get_backoff, fetch_checksum, ttfb_trace_config,
+                               CHECKSUM_SUFFIX, CHUNK_SIZE)
+from common.manifest import Manifest, Artifact, Status
+from common.transfer import OnChunk, get_part_fpath, stream_to_part
+from common.writer import WriteConfig, WRITERS
+from metrics import Metrics
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
@@ -19,46 +30,259 @@ logger = logging.getLogger()
 async def asynchronous_download(sess: aiohttp.ClientSession,
                                 url: str,
                                 fpath: Path,
-                                chunk_size: int = 1024) -> float:
-    async with (sess.get(url) as resp, \
-                aiofiles.open(fpath, mode='wb') as f):
-        assert resp.status == 200
-        fsize = resp.headers['Content-Length']
-        async for data in resp.content.iter_chunked(chunk_size):
-            await f.write(data)
+                                chunk_size: int = CHUNK_SIZE,
+                                on_chunk: OnChunk | None = None,
+                                write_config: WriteConfig | None = None) -> float:
+    '''It downloads a file through `<fname>.part` and renames it to `fpath`
+    only once every byte has arrived
+    '''
+    part_fpath = get_part_fpath(fpath)
+    size = await stream_to_part(sess, url, part_fpath, chunk_size,
+                                on_chunk=on_chunk,
+                                write_config=write_config)
+    await aiofiles.os.replace(part_fpath, fpath)
     logger.debug(f'{fpath.name} is downloaded')
-    return float(fsize)
+    return float(size)
 
 
-async def main(urls: list[str], download_dir: Path, valid_dir: Path):
-    total_size = 0
-    async with (aiohttp.ClientSession() as sess):
-        for i, url in enumerate(urls):
-            url = urlparse(url)
-            fname = url.path.split('/')[-1]
-            
-            fpath = Path(os.path.join(valid_dir, fname))
-            if await aiofiles.os.path.exists(fpath):
-                total_size += await aiofiles.os.path.getsize(fpath)
-                continue
-            
-            fpath = Path(os.path.join(download_dir, fname))
+async def verified_download(sess: aiohttp.ClientSession,
+                            url: str,
+                            fpath: Path,
+                            valid_fpath: Path,
+                            chunk_size: int = CHUNK_SIZE,
+                            on_chunk: OnChunk | None = None,
+                            write_config: WriteConfig | None = None) -> tuple[float, str]:
+    '''It hashes a file while it is downloaded and moves it to
+    `valid_fpath` if it matches its `.CHECKSUM`
+    '''
+    checksum = await fetch_checksum(sess, url, fpath.parent)
+    part_fpath = get_part_fpath(fpath)
+    hasher = hashlib.sha256()
+    size = await stream_to_part(sess, url, part_fpath, chunk_size, hasher,
+                                on_chunk, write_config)
+    if hasher.hexdigest() != checksum:
+        await aiofiles.os.remove(part_fpath)
+        raise ChecksumError(
+            f'{fpath.name} is failed {checksum}/{hasher.hexdigest()}')
+    await aiofiles.os.replace(part_fpath, valid_fpath)
+    logger.debug(f'{fpath.name} is valid')
+    return float(size), checksum
+
+
+@dc.dataclass
+class Progress:
+    total: int
+    done: int = 0
+    size: float = 0
+
+    def update(self, size: float):
+        self.done += 1
+        self.size += size
+        if (self.done % 100 == 0) or (self.done == self.total):
+            logger.info(f'===== {self.done/self.total*100:.2f}%, {self.size/10**6:.2f} MB is Downloaded =====')
+
+
+def create_connector(limit: int, limit_per_host: int) -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(limit=limit,
+                                limit_per_host=limit_per_host,
+                                use_dns_cache=True,
+                                ttl_dns_cache=300,
+                                keepalive_timeout=60)
+
+
+@dc.dataclass
+class Downloader:
+    sess: aiohttp.ClientSession
+    controller: Controller
+    download_dir: Path
+    valid_dir: Path
+    verify: bool = False
+    manifest: Manifest | None = None
+    max_retries: int = 5
+    metrics: Metrics = dc.field(default_factory=Metrics)
+    write_config: WriteConfig = dc.field(default_factory=WriteConfig)
+    retries: set[asyncio.Task] = dc.field(default_factory=set)
+
+    async def download(self, url: str) -> float:
+        fname = urlparse(url).path.split('/')[-1]
+        for dirpath, status in [(self.valid_dir, Status.VALID),
+                                (self.download_dir, Status.DOWNLOADED)]:
+            fpath = Path(os.path.join(dirpath, fname))
             if await aiofiles.os.path.exists(fpath):
-                total_size += await aiofiles.os.path.getsize(fpath)
-                continue
+                self.record(url, status, fpath=str(fpath))
+                self.metrics.observe_file('skipped')
+                return await aiofiles.os.path.getsize(fpath)
 
-            fsize = await asynchronous_download(sess, url.geturl(), fpath)
-            total_size += fsize
-            
-            if (i % 100 == 0) or (i == len(urls) - 1):
-                logger.info(f'===== {i/len(urls)*100:.2f}%, {total_size/10**6:.2f} MB is Downloaded =====')
+        self.record(url, Status.DOWNLOADING, attempt=True)
+        start = time.monotonic()
+        if self.verify and not fname.endswith(CHECKSUM_SUFFIX):
+            valid_fpath = Path(os.path.join(self.valid_dir, fname))
+            async with self.controller:
+                fsize, checksum = await verified_download(
+                    self.sess, url, fpath, valid_fpath,
+                    on_chunk=self.metrics.observe_chunk,
+                    write_config=self.write_config)
+            self.record(url, Status.VALID, fpath=str(valid_fpath),
+                        sha256=checksum)
+            self.metrics.observe_file('valid', time.monotonic() - start)
+            return fsize
+
+        async with self.controller:
+            fsize = await asynchronous_download(
+                self.sess, url, fpath,
+                on_chunk=self.metrics.observe_chunk,
+                write_config=self.write_config)
+        self.record(url, Status.DOWNLOADED, fpath=str(fpath))
+        self.metrics.observe_file('downloaded', time.monotonic() - start)
+        return fsize
+
+    def record(self, url: str, status: Status, **values):
+        if self.manifest:
+            self.manifest.update(url, status, **values)
+
+    async def retry(self, queue: asyncio.Queue[tuple[str, int]], url: str,
+                    attempt: int, delay: float):
+        '''It puts a failed url back after a backoff without holding a worker,
+        the url is done only once its retry is queued
+        '''
+        await asyncio.sleep(delay)
+        await queue.put((url, attempt + 1))
+        queue.task_done()
+
+    async def worker(self, queue: asyncio.Queue[tuple[str, int]],
+                     progress: Progress):
+        while True:
+            url, attempt = await queue.get()
+            try:
+                fsize = await self.download(url)
+            except Exception as e:
+                retried = is_retryable(e) and attempt < self.max_retries
+                self.metrics.observe_error(e, retried)
+                if retried:
+                    # a corrupted file isn't a sign of load, no backoff
+                    delay = 0 if isinstance(e, ChecksumError) else \
+                            get_backoff(attempt)
+                    logger.info(f'{url} is retried in {delay:.1f} sec: {e!r}')
+                    task = asyncio.create_task(
+                        self.retry(queue, url, attempt, delay))
+                    self.retries.add(task)
+                    task.add_done_callback(self.retries.discard)
+                    continue
+                logger.error(f'{url} is failed: {e!r}')
+                self.record(url, Status.FAILED)
+                self.metrics.observe_file('failed')
+                fsize = 0
+            progress.update(fsize)
+            queue.task_done()
+
+
+async def main(urls: list[str],
+               download_dir: Path,
+               valid_dir: Path,
+               limit: int = 64,
+               limit_per_host: int = 32,
+               verify: bool = False,
+               manifest: Manifest | None = None,
+               max_retries: int = 5,
+               metrics_port: int | None = None,
+               metrics_interval: float = 0,
+               write_config: WriteConfig | None = None):
+    queue = asyncio.Queue(maxsize=limit * 2)
+    progress = Progress(len(urls))
+    controller = Controller(limit)
+    metrics = Metrics()
+    connector = create_connector(limit, limit_per_host)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    trace_configs = [
+        ttfb_trace_config(controller.on_latency, metrics.observe_ttfb)
+    ]
+    async with (aiohttp.ClientSession(connector=connector,
+                                      timeout=timeout,
+                                      trace_configs=trace_configs) as sess):
+        downloader = Downloader(sess, controller, download_dir, valid_dir,
+                                verify, manifest, max_retries, metrics,
+                                write_config or WriteConfig())
+        metrics.register_gauge('downloader_files_in_flight',
+                               'downloads holding a concurrency slot',
+                               lambda: controller.in_flight)
+        metrics.register_gauge('downloader_concurrency_limit',
+                               'adaptive concurrency limit',
+                               lambda: int(controller.limit))
+        metrics.register_gauge('downloader_queue_depth',
+                               'urls waiting for a worker or a retry',
+                               lambda: queue.qsize() + len(downloader.retries))
+
+        tasks = [
+            asyncio.create_task(downloader.worker(queue, progress))
+            for _ in range(limit)
+        ]
+        runner = None
+        if metrics_port:
+            runner = await metrics.serve('0.0.0.0', metrics_port)
+        if metrics_interval:
+            tasks.append(asyncio.create_task(metrics.report(metrics_interval)))
+
+        for url in urls:
+            await queue.put((url, 0))
+        await queue.join()
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if runner:
+            await runner.cleanup()
+        if metrics_port or metrics_interval:
+            logger.info(f'metrics {json.dumps(metrics.snapshot())}')
 
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Historical Data Downloader')
-    parser.add_argument('links', type=Path, help='file download links csv')
+    parser.add_argument('links',
+                        type=Path,
+                        nargs='?',
+                        help='file download links csv')
     parser.add_argument('--download_dir', '-d', type=Path)
     parser.add_argument('--valid_dir', '-v', type=Path)
+    parser.add_argument('--limit',
+                        '-l',
+                        type=int,
+                        default=64,
+                        help='the number of maximum concurrent downloads, '
+                        'the concurrency adapts to errors and latency below it')
+    parser.add_argument('--limit_per_host',
+                        type=int,
+                        default=32,
+                        help='the number of maximum connections per host')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='check sha256 while downloading and '
+                        'move valid files to valid_dir')
+    parser.add_argument('--max_retries',
+                        type=int,
+                        default=5,
+                        help='the number of retries of a transient failure')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        help='port to serve prometheus metrics at /metrics')
+    parser.add_argument('--metrics_interval',
+                        type=float,
+                        default=0,
+                        help='seconds between json metrics snapshots in logs')
+    parser.add_argument('--writer',
+                        choices=list(WRITERS),
+                        default='buffered',
+                        help='how downloaded chunks are written to disk')
+    parser.add_argument('--buffer_size',
+                        type=float,
+                        default=1,
+                        help='MiB of chunks coalesced into a write')
+    parser.add_argument('--preallocate',
+                        action='store_true',
+                        help='reserve disk blocks for Content-Length')
+    parser.add_argument('--manifest',
+                        '-m',
+                        type=Path,
+                        help='artifact manifest db shared with the other tools')
     return parser.parse_args()
 
 
@@ -77,15 +301,35 @@ if __name__ == "__main__":
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
 
-    with open(args.links, 'r') as f:
-        urls = f.readlines()
-    if not urls:
+    urls = []
+    if args.links:
+        with open(args.links, 'r') as f:
+            urls = [line.strip() for line in f if line.strip()]
+
+    manifest = None
+    if args.manifest:
+        manifest = Manifest(args.manifest)
+        manifest.upsert(map(Artifact, urls))
+        artifacts = manifest.select(Status.LISTED, Status.DOWNLOADING,
+                                    Status.FAILED)
+        urls = [artifact.url for artifact in artifacts]
+        logger.info(f'Manifest: {manifest.count()}')
+    if not urls and not manifest:
         raise ValueError('No File Download Links')
     logger.info(f'#{len(urls)} Files will be downloaded')
 
     try:
         t1 = time.time()
-        asyncio.run(main(urls, download_dir, valid_dir))
+        asyncio.run(
+            main(urls, download_dir, valid_dir, args.limit,
+                 args.limit_per_host, args.verify, manifest,
+                 args.max_retries, args.metrics_port,
+                 args.metrics_interval,
+                 WriteConfig(args.writer, int(args.buffer_size * 2**20),
+                             args.preallocate)))
         print(f'{time.time() - t1:.2f} sec')
     except KeyboardInterrupt:
         logger.info('===== FINISH ======')
+    finally:
+        if manifest:
+            manifest.close()
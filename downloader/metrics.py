@@ -0,0 +1,147 @@
+from __future__ import annotations
+import asyncio
+import bisect
+import json
+import time
+import logging
+import logging.config
+from collections import Counter
+from typing import Callable
+
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+class Histogram:
+
+    def __init__(self, buckets: list[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str) -> list[str]:
+        lines, cumulative = [], 0
+        for bucket, cnt in zip(self.buckets, self.counts):
+            cumulative += cnt
+            lines.append(f'{name}_bucket{{le="{bucket}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+    def asdict(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0,
+            'buckets': dict(zip(map(str, self.buckets), self.counts)),
+        }
+
+
+class Metrics:
+    '''Throughput, latency and error metrics of the downloader,
+    served in the Prometheus text format or logged as JSON snapshots
+    '''
+
+    def __init__(self) -> None:
+        self.started_at = time.monotonic()
+        self.bytes = 0
+        self.files = Counter()  # by result
+        self.retries = 0
+        self.errors = Counter()  # by status
+        self.file_seconds = Histogram(LATENCY_BUCKETS)
+        self.ttfb_seconds = Histogram(LATENCY_BUCKETS)
+        self.gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+        self.last_snapshot = (self.started_at, 0)
+
+    def register_gauge(self, name: str, help: str, func: Callable[[], float]):
+        self.gauges[name] = (help, func)
+
+    def observe_file(self, result: str, seconds: float | None = None):
+        self.files[result] += 1
+        if seconds is not None:
+            self.file_seconds.observe(seconds)
+
+    def observe_chunk(self, data: bytes):
+        self.bytes += len(data)
+
+    def observe_error(self, e: BaseException, retried: bool):
+        status = getattr(e, 'status', None) or type(e).__name__
+        self.errors[str(status)] += 1
+        if retried:
+            self.retries += 1
+
+    def observe_ttfb(self, seconds: float):
+        self.ttfb_seconds.observe(seconds)
+
+    def render(self) -> str:
+        lines = [
+            '# TYPE downloader_bytes_total counter',
+            f'downloader_bytes_total {self.bytes}',
+            '# TYPE downloader_files_total counter',
+            *[f'downloader_files_total{{result="{result}"}} {cnt}'
+              for result, cnt in self.files.items()],
+            '# TYPE downloader_retries_total counter',
+            f'downloader_retries_total {self.retries}',
+            '# TYPE downloader_errors_total counter',
+            *[f'downloader_errors_total{{status="{status}"}} {cnt}'
+              for status, cnt in self.errors.items()],
+            '# TYPE downloader_file_seconds histogram',
+            *self.file_seconds.render('downloader_file_seconds'),
+            '# TYPE downloader_ttfb_seconds histogram',
+            *self.ttfb_seconds.render('downloader_ttfb_seconds'),
+        ]
+        for name, (help, func) in self.gauges.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        since, size = self.last_snapshot
+        self.last_snapshot = (now, self.bytes)
+        return {
+            'elapsed_sec': round(now - self.started_at, 3),
+            'bytes': self.bytes,
+            'bytes_per_sec': round((self.bytes - size) / (now - since), 1),
+            'files': dict(self.files),
+            'retries': self.retries,
+            'errors': dict(self.errors),
+            'file_seconds': self.file_seconds.asdict(),
+            'ttfb_seconds': self.ttfb_seconds.asdict(),
+            **{name: func() for name, (_, func) in self.gauges.items()},
+        }
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        '''It serves `GET /metrics` until the returned runner is cleaned up
+        '''
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(),
+                                content_type='text/plain',
+                                charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f'Serve metrics at http://{host}:{port}/metrics')
+        return runner
+
+    async def report(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f'metrics {json.dumps(self.snapshot())}')
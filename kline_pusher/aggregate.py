@@ -0,0 +1,258 @@
+"""Higher timeframes derived from the 1m klines
+
+Every `TimeFrame` above 1m is reduced from a finer one whose buckets nest in
+its own (3m and 5m from 1m, 15m from 5m, ..., 1w and 1mo from 1d), so the 1m
+series is resampled once and the rest is built from ever smaller arrays. Only
+the 1m archives have to be downloaded and parsed.
+
+- open/close: the first/last of a bucket
+- high/low: the max/min of a bucket
+- volumes, quote volumes and the number of trades: the sum of a bucket
+
+New 1m klines update only the buckets they fall in, a bucket is always
+rebuilt from every 1m kline of it in the database.
+
+>>> python aggregate.py BTCUSDT ETHUSDT --start 2023-01-01
+"""
+from __future__ import annotations
+import time
+import argparse
+import datetime as dt
+import logging
+import logging.config
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy.engine import Connection
+
+import database
+import crud
+import datamodel
+from datamodel import KlineBatch, TimeFrame
+from loader import LOADERS
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+MINUTE = 60_000
+# milliseconds of the fixed timeframes, `1mo` is aligned to the calendar
+STEPS = {
+    TimeFrame.MINUTE_1: MINUTE,
+    TimeFrame.MINUTE_3: 3 * MINUTE,
+    TimeFrame.MINUTE_5: 5 * MINUTE,
+    TimeFrame.MINUTE_15: 15 * MINUTE,
+    TimeFrame.MINUTE_30: 30 * MINUTE,
+    TimeFrame.HOUR_1: 60 * MINUTE,
+    TimeFrame.HOUR_2: 120 * MINUTE,
+    TimeFrame.HOUR_4: 240 * MINUTE,
+    TimeFrame.HOUR_6: 360 * MINUTE,
+    TimeFrame.HOUR_8: 480 * MINUTE,
+    TimeFrame.HOUR_12: 720 * MINUTE,
+    TimeFrame.DAY_1: 1440 * MINUTE,
+    TimeFrame.DAY_3: 3 * 1440 * MINUTE,
+    TimeFrame.WEEK_1: 7 * 1440 * MINUTE,
+}
+# 1970-01-05 is the first monday after the epoch
+WEEK_ORIGIN = 4 * 1440 * MINUTE
+
+# the finer timeframe every timeframe is reduced from, in order
+SOURCES = {
+    TimeFrame.MINUTE_3: TimeFrame.MINUTE_1,
+    TimeFrame.MINUTE_5: TimeFrame.MINUTE_1,
+    TimeFrame.MINUTE_15: TimeFrame.MINUTE_5,
+    TimeFrame.MINUTE_30: TimeFrame.MINUTE_15,
+    TimeFrame.HOUR_1: TimeFrame.MINUTE_30,
+    TimeFrame.HOUR_2: TimeFrame.HOUR_1,
+    TimeFrame.HOUR_4: TimeFrame.HOUR_2,
+    TimeFrame.HOUR_6: TimeFrame.HOUR_2,
+    TimeFrame.HOUR_8: TimeFrame.HOUR_4,
+    TimeFrame.HOUR_12: TimeFrame.HOUR_6,
+    TimeFrame.DAY_1: TimeFrame.HOUR_12,
+    TimeFrame.DAY_3: TimeFrame.DAY_1,
+    TimeFrame.WEEK_1: TimeFrame.DAY_1,
+    TimeFrame.MONTH_1: TimeFrame.DAY_1,
+}
+SUM_COLUMNS = [
+    "volume",
+    "quote_asset_volume",
+    "number_of_trade",
+    "taker_buy_base_asset_volume",
+    "taker_buy_quote_asset_volume",
+]
+
+
+def floor(timeframe: TimeFrame, opentime: np.ndarray) -> np.ndarray:
+    """It returns the opentime of the bucket of every epoch millisecond"""
+    if timeframe is TimeFrame.MONTH_1:
+        month = opentime.astype("datetime64[ms]").astype("datetime64[M]")
+        return month.astype("datetime64[ms]").astype(np.int64)
+    origin = WEEK_ORIGIN if timeframe is TimeFrame.WEEK_1 else 0
+    return opentime - (opentime - origin) % STEPS[timeframe]
+
+
+def next_floor(timeframe: TimeFrame, opentime: np.ndarray) -> np.ndarray:
+    """It returns the opentime of the bucket after the bucket of `opentime`"""
+    if timeframe is TimeFrame.MONTH_1:
+        month = opentime.astype("datetime64[ms]").astype("datetime64[M]") + 1
+        return month.astype("datetime64[ms]").astype(np.int64)
+    return floor(timeframe, opentime) + STEPS[timeframe]
+
+
+def resample(batch: KlineBatch, timeframe: TimeFrame) -> KlineBatch:
+    """It reduces klines ordered by opentime into the buckets of `timeframe`
+    by a vectorized pass on every column"""
+    if not len(batch):
+        return KlineBatch(batch.pid, dict(batch.columns))
+    opentime = floor(timeframe, batch.columns["opentime"].astype(np.int64))
+    starts = np.flatnonzero(np.r_[True, opentime[1:] != opentime[:-1]])
+    stops = np.r_[starts[1:], len(opentime)] - 1
+    columns = batch.columns
+    buckets = {
+        "opentime": opentime[starts].astype("datetime64[ms]"),
+        "open": columns["open"][starts],
+        "high": np.maximum.reduceat(columns["high"], starts),
+        "low": np.minimum.reduceat(columns["low"], starts),
+        "close": columns["close"][stops],
+        "closetime": (next_floor(timeframe, opentime[starts]) - 1).astype(
+            "datetime64[ms]"
+        ),
+        "ignore": np.zeros(len(starts)),
+    }
+    for name in SUM_COLUMNS:
+        buckets[name] = np.add.reduceat(columns[name], starts)
+    return KlineBatch(batch.pid, buckets)
+
+
+def derive(batch: KlineBatch) -> dict[TimeFrame, KlineBatch]:
+    """It builds every higher timeframe of 1m klines"""
+    batches = {TimeFrame.MINUTE_1: batch}
+    for timeframe, source in SOURCES.items():
+        batches[timeframe] = resample(batches[source], timeframe)
+    del batches[TimeFrame.MINUTE_1]
+    return batches
+
+
+def to_millis(value: dt.datetime | np.datetime64) -> int:
+    return int(np.datetime64(value, "ms").astype(np.int64))
+
+
+def to_datetime(millis: int) -> dt.datetime:
+    return np.datetime64(millis, "ms").astype(dt.datetime)
+
+
+def update_window(
+    conn: Connection, pid: int, first: int, last: int, loader: str | None = None
+) -> int:
+    """It rebuilds the buckets of every higher timeframe holding a 1m kline
+    opened from `first` to `last` (epoch milliseconds) and returns their count"""
+    bounds = np.array([first, last], dtype=np.int64)
+    floors = {timeframe: floor(timeframe, bounds) for timeframe in SOURCES}
+    start = min(int(floors[timeframe][0]) for timeframe in SOURCES)
+    end = max(
+        int(next_floor(timeframe, floors[timeframe][1:])[0]) for timeframe in SOURCES
+    )
+
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    batch = crud.KlineTable.read_batch(
+        conn, table, pid, to_datetime(start), to_datetime(end)
+    )
+    n_rows = 0
+    for timeframe, derived in derive(batch).items():
+        # the buckets on the edges of the window may miss their 1m klines
+        opentime = derived.columns["opentime"].astype(np.int64)
+        lower, upper = np.searchsorted(opentime, floors[timeframe] + [0, 1])
+        derived = derived[lower:upper]
+        if not len(derived):
+            continue
+        crud.KlineTable.insert_batches(
+            conn, timeframe.get_mapped_table(), [derived], loader
+        )
+        n_rows += len(derived)
+    return n_rows
+
+
+def update(
+    conn: Connection,
+    pid: int,
+    first: dt.datetime | np.datetime64,
+    last: dt.datetime | np.datetime64,
+    loader: str | None = None,
+) -> int:
+    """It rebuilds the higher timeframes of the 1m klines from `first` to `last`,
+    a month at a time so the 1m klines read at once stay bounded"""
+    first, last = to_millis(first), to_millis(last)
+    n_rows = 0
+    while first <= last:
+        month_end = int(next_floor(TimeFrame.MONTH_1, np.array([first]))[0])
+        n_rows += update_window(conn, pid, first, min(last, month_end - 1), loader)
+        first = month_end
+    return n_rows
+
+
+def main(
+    names: list[str],
+    start: dt.date | None = None,
+    end: dt.date | None = None,
+    loader: str | None = None,
+):
+    with database.get_session() as sess:
+        pairs = crud.MarketPair.read_all(sess)
+    if names:
+        names = {name.upper() for name in names}
+        pairs = [pair for pair in pairs if pair.name in names]
+
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    for pair in pairs:
+        with database.get_engine().connect() as conn:
+            span = crud.KlineTable.read_span(conn, table, pair.id)
+        if span is None:
+            logger.info(f"{pair.name} has no 1m klines")
+            continue
+        first, last = span
+        if start:
+            first = max(first, dt.datetime.combine(start, dt.time()))
+        if end:
+            last = min(last, dt.datetime.combine(end, dt.time(23, 59)))
+        with database.get_engine().begin() as conn:
+            n_rows = update(conn, pair.id, first, last, loader)
+        logger.info(f"===== {pair.name}: #{n_rows} klines are derived =====")
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Derive the higher timeframes from the 1m klines"
+    )
+    parser.add_argument("pairs", nargs="*", help="pairs to derive, every pair if empty")
+    parser.add_argument(
+        "--start",
+        type=dt.date.fromisoformat,
+        help="the first date of the 1m klines (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--end",
+        type=dt.date.fromisoformat,
+        help="the last date of the 1m klines (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--loader",
+        choices=list(LOADERS),
+        help="bulk-load backend, sqlite or executemany by the database",
+    )
+    parser.add_argument("--env", help="env filepath", default=".env")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    load_dotenv(args.env)
+
+    kwargs = {"local_infile": True} if args.loader == "load_data" else {}
+    database.on_startup(database.get_config(), future=True, **kwargs)
+    datamodel.create_tables()
+
+    start = time.perf_counter()
+    main(args.pairs, args.start, args.end, args.loader)
+    print(time.perf_counter() - start)
+
+    database.on_shutdown()
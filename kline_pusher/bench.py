@@ -0,0 +1,152 @@
+"""Rows/s of the bulk-load backends
+
+It loads synthetic klines into a scratch `bench_kline` table with every
+backend the database supports and a few batch sizes. `insert_bulk` is the
+baseline of a dict per row through sqlalchemy.
+
+>>> DB_URL=mysql+pymysql://user:pw@127.0.0.1:3306/klines python bench.py \
+        --rows 1000000 --batch_rows 10000 100000 --output bench.json
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import tempfile
+import time
+import logging
+import logging.config
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+import database
+from datamodel import KLINE_COLUMNS, KlineBatch, KlineTable, Pair
+from loader import LOADERS
+from main import chunk_batches
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+
+def create_batch(pid: int, n_rows: int, seed: int = 0) -> KlineBatch:
+    rng = np.random.default_rng(seed)
+    opentime = 1672531200000 + np.arange(n_rows, dtype=np.int64) * 60_000
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.001, n_rows)))
+    volume = rng.lognormal(0, 1, n_rows)
+    columns = {
+        "opentime": opentime.astype("datetime64[ms]"),
+        "open": np.roll(close, 1),
+        "high": close * 1.001,
+        "low": close * 0.999,
+        "close": close,
+        "volume": volume,
+        "closetime": (opentime + 59_999).astype("datetime64[ms]"),
+        "quote_asset_volume": volume * close,
+        "number_of_trade": rng.integers(1, 500, n_rows),
+        "taker_buy_base_asset_volume": volume / 2,
+        "taker_buy_quote_asset_volume": volume * close / 2,
+        "ignore": np.zeros(n_rows),
+    }
+    assert list(columns) == KLINE_COLUMNS
+    return KlineBatch(pid, columns)
+
+
+def get_pid(name: str = "BENCH") -> int:
+    with database.get_session() as sess:
+        pid = sess.scalar(select(Pair.id).where(Pair.name == name))
+        if pid is None:
+            sess.add(Pair(name))
+            sess.commit()
+            pid = sess.scalar(select(Pair.id).where(Pair.name == name))
+    return pid
+
+
+def run_case(batch: KlineBatch, loader: str, batch_rows: int) -> dict:
+    engine = database.get_engine()
+    table = KlineTable("bench_kline")
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    try:
+        started_at, cpu_started_at = time.perf_counter(), time.process_time()
+        for chunk in chunk_batches([batch], batch_rows):
+            with engine.begin() as conn:
+                if loader == "insert_bulk":
+                    names = [column.name for column in table.columns]
+                    data = [
+                        dict(zip(names, row))
+                        for part in chunk
+                        for row in part.rows(names)
+                    ]
+                    conn.execute(table.insert(), data)
+                else:
+                    LOADERS[loader].load(conn, table, chunk)
+        elapsed = time.perf_counter() - started_at
+        cpu_sec = time.process_time() - cpu_started_at
+    finally:
+        table.drop(engine)
+        table.metadata.remove(table)
+    return {
+        "loader": loader,
+        "batch_rows": batch_rows,
+        "rows": len(batch),
+        "elapsed_sec": round(elapsed, 3),
+        "rows_per_sec": round(len(batch) / elapsed, 1),
+        "cpu_sec": round(cpu_sec, 3),
+    }
+
+
+def main(n_rows: int, batch_sizes: list[int], loaders: list[str]) -> list[dict]:
+    Pair.__table__.create(database.get_engine(), checkfirst=True)
+    batch = create_batch(get_pid(), n_rows)
+    with database.get_engine().connect() as conn:
+        loaders = [
+            loader
+            for loader in loaders
+            if loader == "insert_bulk" or LOADERS[loader].supports(conn)
+        ]
+
+    results = []
+    for loader in loaders:
+        for batch_rows in batch_sizes:
+            result = run_case(batch, loader, batch_rows)
+            logger.info(json.dumps(result))
+            results.append(result)
+    return results
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark of the bulk loaders")
+    parser.add_argument("--rows", "-n", type=int, default=200_000)
+    parser.add_argument(
+        "--batch_rows", "-b", type=int, nargs="+", default=[10_000, 100_000]
+    )
+    parser.add_argument(
+        "--loaders",
+        "-l",
+        nargs="+",
+        choices=["insert_bulk", *LOADERS],
+        default=["insert_bulk", *LOADERS],
+        help="the backends unsupported by the database are skipped",
+    )
+    parser.add_argument("--output", "-o", help="json report")
+    parser.add_argument("--env", help="env filepath", default=".env")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    load_dotenv(args.env)
+    config = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    if os.getenv("DB_URL") or os.getenv("DB_HOST"):
+        config = database.get_config()
+    database.on_startup(config, future=True, local_infile=True)
+
+    try:
+        results = main(args.rows, args.batch_rows, args.loaders)
+    finally:
+        database.on_shutdown()
+    if args.output:
+        with open(args.output, mode="w") as f:
+            json.dump(results, f, indent=2)
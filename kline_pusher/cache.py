@@ -0,0 +1,71 @@
+"""In-process LRU cache of kline chunks
+
+A chunk is the klines of a pair and a timeframe in a calendar month. Only the
+months before the current one are cached, they don't change once ingested.
+The cache is bounded by the bytes of the NumPy columns, the least recently
+read chunks are evicted first. A process ingesting data again has to
+`invalidate` what it read before.
+"""
+from __future__ import annotations
+import collections
+import threading
+from typing import Callable, Hashable
+
+from attrs import define, field
+
+from datamodel import KlineBatch
+
+
+@define
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+@define
+class ChunkCache:
+    max_bytes: int = 256 * 2**20
+    size: int = 0
+    stats: CacheStats = field(factory=CacheStats)
+    chunks: collections.OrderedDict = field(factory=collections.OrderedDict)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def get(self, key: Hashable, read: Callable[[], KlineBatch]) -> KlineBatch:
+        """It returns the cached chunk of `key` or the one `read` returns,
+        the columns of a cached chunk are read-only"""
+        with self.lock:
+            if key in self.chunks:
+                self.chunks.move_to_end(key)
+                self.stats.hits += 1
+                return self.chunks[key]
+            self.stats.misses += 1
+
+        batch = read()  # outside of the lock, a miss doesn't block the hits
+        for column in batch.columns.values():
+            column.flags.writeable = False
+        nbytes = get_nbytes(batch)
+        if nbytes > self.max_bytes:
+            return batch
+        with self.lock:
+            if key not in self.chunks:
+                self.chunks[key] = batch
+                self.size += nbytes
+            self.evict()
+        return batch
+
+    def evict(self):
+        while self.size > self.max_bytes:
+            _, batch = self.chunks.popitem(last=False)
+            self.size -= get_nbytes(batch)
+            self.stats.evictions += 1
+
+    def invalidate(self, match: Callable[[Hashable], bool] = lambda key: True):
+        """It drops the chunks whose key matches, every chunk by default"""
+        with self.lock:
+            for key in [key for key in self.chunks if match(key)]:
+                self.size -= get_nbytes(self.chunks.pop(key))
+
+
+def get_nbytes(batch: KlineBatch) -> int:
+    return sum(column.nbytes for column in batch.columns.values())
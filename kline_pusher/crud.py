@@ -1,8 +1,18 @@
-from sqlalchemy import select, insert, join, delete, update
+from __future__ import annotations
+import datetime as dt
+
+import numpy as np
+from sqlalchemy import select, insert, join, delete, update, func
 from sqlalchemy.engine import Connection
 from sqlalchemy.orm import Session
 
-from datamodel import KlineRecord, Pair, Table
+from datamodel import IngestedFile, KlineBatch, KlineRecord, Pair, Table, TimeFrame
+from loader import get_loader
+from cache import ChunkCache
+
+
+# chunks of the past months read by `KlineTable.read_range`
+CHUNK_CACHE = ChunkCache()
 
 
 class MarketPair:
@@ -33,3 +43,154 @@ class KlineTable:
     def insert_bulk(cls, conn: Connection, table: Table, records: list[KlineRecord]):
         data = [record.asdict() for record in records]
         conn.execute(table.insert(), data)
+
+    @classmethod
+    def insert_batches(
+        cls,
+        conn: Connection,
+        table: Table,
+        batches: list[KlineBatch],
+        loader: str | None = None,
+    ):
+        """`loader` is a backend of loader.py, the best one for the dialect
+        by default"""
+        get_loader(conn, loader).load(conn, table, batches)
+
+    @classmethod
+    def read_batch(
+        cls,
+        conn: Connection,
+        table: Table,
+        pid: int,
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> KlineBatch:
+        """It reads the klines of a pair opened from `start` until `end`
+        (exclusive) in order as NumPy columns"""
+        columns = [column for column in table.columns if column.name != "pid"]
+        stmt = (
+            select(*columns)
+            .where(table.c.pid == pid)
+            .where(table.c.opentime >= start, table.c.opentime < end)
+            .order_by(table.c.opentime)
+        )
+        rows = conn.execute(stmt).all()
+        return KlineBatch.from_rows(pid, [column.name for column in columns], rows)
+
+    @classmethod
+    def read_range(
+        cls,
+        conn: Connection,
+        pair: Pair | int,
+        timeframe: TimeFrame,
+        start: dt.datetime,
+        end: dt.datetime,
+        cache: ChunkCache | None = CHUNK_CACHE,
+    ) -> KlineBatch:
+        """It reads the klines of a pair opened from `start` until `end`
+        (exclusive) as NumPy columns. The months before the current one are
+        read whole and kept in `cache`, the rest is read by the range."""
+        pid = pair if isinstance(pair, int) else pair.id
+        table = timeframe.get_mapped_table()
+        if cache is None or start >= end:
+            return cls.read_batch(conn, table, pid, start, end)
+
+        lower, upper = np.datetime64(start, "ms"), np.datetime64(end, "ms")
+        now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+        current = np.datetime64(now, "M")
+        batches = []
+        month = lower.astype("datetime64[M]")
+        while month.astype("datetime64[ms]") < upper:
+            month_start = month.astype("datetime64[ms]")
+            month_end = (month + 1).astype("datetime64[ms]")
+            if month >= current:  # the rest may still be ingested
+                first, last = max(lower, month_start), upper
+                batches.append(
+                    cls.read_batch(conn, table, pid, first.item(), last.item())
+                )
+                break
+            batch = cache.get(
+                (pid, timeframe, str(month)),
+                lambda: cls.read_batch(
+                    conn, table, pid, month_start.item(), month_end.item()
+                ),
+            )
+            opentime = batch.columns["opentime"]
+            first, last = np.searchsorted(opentime, [lower, upper])
+            batches.append(batch[first:last])
+            month += 1
+        return KlineBatch.concat(pid, batches)
+
+    @classmethod
+    def read_opentimes(cls, conn: Connection, table: Table, pid: int) -> np.ndarray:
+        """It reads only the opentimes of a pair in order"""
+        stmt = select(table.c.opentime).where(table.c.pid == pid)
+        opentimes = conn.scalars(stmt.order_by(table.c.opentime)).all()
+        return np.array(opentimes, dtype="datetime64[ms]")
+
+    @classmethod
+    def read_span(
+        cls, conn: Connection, table: Table, pid: int
+    ) -> tuple[dt.datetime, dt.datetime] | None:
+        """It returns the first and the last opentime of a pair"""
+        stmt = select(func.min(table.c.opentime), func.max(table.c.opentime))
+        first, last = conn.execute(stmt.where(table.c.pid == pid)).one()
+        return (first, last) if first is not None else None
+
+
+class Ledger:
+    @classmethod
+    def read_all(cls, conn: Connection) -> dict[str, str]:
+        """It returns the sha256 of every ingested file by its name"""
+        stmt = select(IngestedFile.c.fname, IngestedFile.c.sha256)
+        return dict(conn.execute(stmt).all())
+
+    @classmethod
+    def read_stats(cls, conn: Connection) -> dict[str, tuple[str, int, int]]:
+        """It returns the sha256, the size and the mtime (ns) of every ingested
+        file by its name, the stat is None when it wasn't recorded"""
+        stmt = select(
+            IngestedFile.c.fname,
+            IngestedFile.c.sha256,
+            IngestedFile.c.size,
+            IngestedFile.c.mtime_ns,
+        )
+        return {fname: tuple(stat) for fname, *stat in conn.execute(stmt)}
+
+    @classmethod
+    def update_stat(cls, conn: Connection, fname: str, size: int, mtime_ns: int):
+        """It records the stat of a file touched without changing"""
+        conn.execute(
+            update(IngestedFile)
+            .where(IngestedFile.c.fname == fname)
+            .values(size=size, mtime_ns=mtime_ns)
+        )
+
+    @classmethod
+    def record(
+        cls,
+        conn: Connection,
+        fname: str,
+        sha256: str,
+        timeframe: str,
+        pid: int,
+        n_rows: int,
+        size: int | None = None,
+        mtime_ns: int | None = None,
+    ):
+        conn.execute(delete(IngestedFile).where(IngestedFile.c.fname == fname))
+        conn.execute(
+            insert(IngestedFile),
+            {
+                "fname": fname,
+                "sha256": sha256,
+                "timeframe": timeframe,
+                "pid": pid,
+                "n_rows": n_rows,
+                "ingested_at": dt.datetime.now(dt.timezone.utc).replace(
+                    microsecond=0, tzinfo=None
+                ),
+                "size": size,
+                "mtime_ns": mtime_ns,
+            },
+        )
@@ -16,6 +16,10 @@ logger = logging.getLogger(__name__)
 
 _engine: Engine | None = None
 
+# the `TIMESTAMP` columns are converted by the session time zone on MySQL,
+# a UTC session stores and reads the naive UTC datetimes as they are
+UTC_SESSION = "SET time_zone = '+00:00'"
+
 
 @define
 class DBConfig:
@@ -51,6 +55,7 @@ def create_engine(
     pool_size: int = 5,
     max_overflow: int = 10,
     ssl_cert_folder: Path | None = None,
+    local_infile: bool = False,
     **kwargs,
 ) -> Engine:
 
@@ -63,7 +68,13 @@ def create_engine(
         database=database,
     )
 
-    connect_args = {"charset": "utf8mb4", "binary_prefix": True}
+    connect_args = {
+        "charset": "utf8mb4",
+        "binary_prefix": True,
+        "init_command": UTC_SESSION,
+    }
+    if local_infile:  # for `LOAD DATA LOCAL INFILE`
+        connect_args["local_infile"] = True
     if ssl_cert_folder:
         connect_args["ssl"] = {
             "cert": os.path.join(ssl_cert_folder, "client-cert.pem"),
@@ -84,13 +95,26 @@ def create_engine(
     )
 
 
-def on_startup(db_config: DBConfig, *args, **kwargs):
+def get_config() -> DBConfig | str:
+    """`DB_URL` (e.g. sqlite:///klines.db) overrides the `DB_*` variables"""
+    return os.getenv("DB_URL") or DBConfig.from_env()
+
+
+def on_startup(db_config: DBConfig | str, *args, **kwargs):
     global _engine
-    _engine = create_engine(
-        *db_config.astuple(),
-        *args,
-        **kwargs,
-    )
+    if isinstance(db_config, str):
+        local_infile = kwargs.pop("local_infile", False)
+        if db_config.startswith("mysql"):
+            kwargs["connect_args"] = {"init_command": UTC_SESSION}
+            if local_infile:
+                kwargs["connect_args"]["local_infile"] = True
+        _engine = _create_engine(db_config, *args, **kwargs)
+    else:
+        _engine = create_engine(
+            *db_config.astuple(),
+            *args,
+            **kwargs,
+        )
     logger.info("DB Connection is opend")
 
 
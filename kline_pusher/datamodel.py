@@ -4,13 +4,18 @@ import logging.config
 from enum import Enum
 from pathlib import PurePath
 import datetime as dt
+import io
 
-from attrs import define, field, asdict
+import numpy as np
+from attrs import define, field, asdict, fields
 from sqlalchemy.orm import registry, relationship
+from sqlalchemy.dialects import sqlite
 from sqlalchemy import (
+    inspect,
     ForeignKey,
     Table,
     Column,
+    BIGINT,
     INTEGER,
     String,
     FLOAT,
@@ -28,7 +33,17 @@ mapper_registry = registry()
 
 
 def create_tables():
-    mapper_registry.metadata.create_all(get_engine())
+    engine = get_engine()
+    mapper_registry.metadata.create_all(engine)
+    # the ledger of an older release misses the nullable stat columns
+    names = {column["name"] for column in inspect(engine).get_columns("ingested_file")}
+    with engine.begin() as conn:
+        for column in IngestedFile.columns:
+            if column.name not in names:
+                column_type = column.type.compile(engine.dialect)
+                conn.exec_driver_sql(
+                    f"ALTER TABLE ingested_file ADD COLUMN {column.name} {column_type}"
+                )
     logger.info("Tables are created")
 
 
@@ -96,19 +111,23 @@ class KlineZipFile:
     fpath: PurePath = field(converter=PurePath)
     timeframe: TimeFrame | None = None
     pair: Pair | None = None
+    date: str = field(init=False, default="")  # YYYY-MM or YYYY-MM-DD
 
     def __attrs_post_init__(self):
+        parts = self.fpath.stem.split("-")
         if not self.timeframe:
-            timeframe = self.fpath.stem.split("-")[1]
-            self.timeframe = TimeFrame(timeframe)
+            self.timeframe = TimeFrame(parts[1])
         if not self.pair:
-            pair_name = self.fpath.stem.split("-")[0].split("_")[0]
+            pair_name = parts[0].split("_")[0]
             self.pair = Pair(pair_name)
+        self.date = "-".join(parts[2:])
 
 
 # fmt: off
-str2timestamp = lambda x: dt.datetime.fromtimestamp(int(x)/1000)\
-                                     .strftime('%Y-%m-%d %H:%M:%S')
+# epoch milliseconds as a naive UTC datetime, like the NumPy columns of
+# `KlineBatch` (it was the local time of the host before)
+str2timestamp = lambda x: dt.datetime.fromtimestamp(int(x)/1000, dt.timezone.utc)\
+                                     .replace(microsecond=0, tzinfo=None)
 @define()
 class KlineRecord:
     pid = field(converter=int)  # pair id
@@ -129,11 +148,123 @@ class KlineRecord:
         return asdict(self)
 # fmt: on
 
+
+def format_timestamps(column: np.ndarray) -> np.ndarray:
+    text = np.datetime_as_string(column.astype("datetime64[s]"))
+    return np.char.replace(text, "T", " ")
+
+
+# the columns of a kline csv, `KlineRecord` without `pid`
+KLINE_COLUMNS = [attr.name for attr in fields(KlineRecord)[1:]]
+INT_COLUMNS = {"opentime", "closetime", "number_of_trade"}
+TIMESTAMP_COLUMNS = {"opentime", "closetime"}
+
+
+@define
+class KlineBatch:
+    """Klines of a file as NumPy columns named after the fields of `KlineRecord`,
+    a whole csv is parsed at once instead of a record per row"""
+
+    pid: int
+    columns: dict[str, np.ndarray]
+    fname: str = ""  # the file the rows are parsed from
+
+    @classmethod
+    def from_csv(cls, pid: int, data: bytes, fname: str = "") -> KlineBatch:
+        if data[:1].isalpha():  # newer archives start with a header row
+            data = data.partition(b"\n")[2]
+        values = np.empty((0, len(KLINE_COLUMNS)))
+        if data.strip():
+            values = np.loadtxt(
+                io.BytesIO(data), delimiter=",", dtype=np.float64, ndmin=2
+            )
+        columns = {}
+        for name, column in zip(KLINE_COLUMNS, values.T):
+            if name in TIMESTAMP_COLUMNS:
+                column = column.astype(np.int64).astype("datetime64[ms]")
+            elif name in INT_COLUMNS:
+                column = column.astype(np.int64)
+            columns[name] = column
+        return cls(pid, columns, fname)
+
+    @classmethod
+    def from_rows(cls, pid: int, names: list[str], rows: list[tuple]) -> KlineBatch:
+        """The inverse of `rows`, the columns not in `names` are left out"""
+        values = list(zip(*rows)) or [()] * len(names)
+        columns = {}
+        for name, column in zip(names, values):
+            if name in TIMESTAMP_COLUMNS:
+                columns[name] = np.array(column, dtype="datetime64[ms]")
+            elif name in INT_COLUMNS:
+                columns[name] = np.array(column, dtype=np.int64)
+            else:
+                columns[name] = np.array(column, dtype=np.float64)
+        return cls(pid, columns)
+
+    @classmethod
+    def concat(cls, pid: int, batches: list[KlineBatch]) -> KlineBatch:
+        if len(batches) == 1:
+            return batches[0]
+        columns = {
+            name: np.concatenate([batch.columns[name] for batch in batches])
+            for name in batches[0].columns
+        }
+        return cls(pid, columns)
+
+    def __len__(self) -> int:
+        return len(self.columns["opentime"])
+
+    def __getitem__(self, rows: slice) -> KlineBatch:
+        """A slice of rows is a view on the same arrays"""
+        columns = {name: column[rows] for name, column in self.columns.items()}
+        return KlineBatch(self.pid, columns, self.fname)
+
+    def rows(self, names: list[str], text_timestamps: bool = False) -> list[tuple]:
+        """It returns the `names` columns as rows of python values,
+        timestamps are datetimes or `YYYY-MM-DD HH:MM:SS` strings"""
+        columns = []
+        for name in names:
+            if name == "pid":
+                columns.append([self.pid] * len(self))
+            elif name in TIMESTAMP_COLUMNS and text_timestamps:
+                columns.append(format_timestamps(self.columns[name]).tolist())
+            elif name in TIMESTAMP_COLUMNS:
+                column = self.columns[name].astype("datetime64[s]")
+                columns.append(column.astype(dt.datetime).tolist())
+            else:
+                columns.append(self.columns[name].tolist())
+        return list(zip(*columns))
+
+    def to_csv(self, names: list[str]) -> bytes:
+        """It renders the `names` columns as csv lines, every column is
+        formatted at once"""
+        columns = []
+        for name in names:
+            if name == "pid":
+                columns.append([str(self.pid)] * len(self))
+            elif name in TIMESTAMP_COLUMNS:
+                columns.append(format_timestamps(self.columns[name]).tolist())
+            else:
+                columns.append(self.columns[name].astype(str).tolist())
+        lines = map(",".join, zip(*columns))
+        return "".join(line + "\n" for line in lines).encode()
+
+
+# sqlite compares timestamps as text, the bound ones are in the format of
+# the rows loaded by `format_timestamps`
+Timestamp = TIMESTAMP().with_variant(
+    sqlite.DATETIME(
+        storage_format="%(year)04d-%(month)02d-%(day)02d "
+        "%(hour)02d:%(minute)02d:%(second)02d"
+    ),
+    "sqlite",
+)
+
 KlineTable = lambda table_name: Table(
     table_name,
     mapper_registry.metadata,
     Column("pid", SMALLINT, ForeignKey("market_pair.id"), primary_key=True),
-    Column("opentime", TIMESTAMP, primary_key=True),
+    Column("opentime", Timestamp, primary_key=True),
     Column("open", FLOAT, nullable=False),
     Column("high", FLOAT, nullable=False),
     Column("low", FLOAT, nullable=False),
@@ -148,14 +279,31 @@ KlineTable = lambda table_name: Table(
 
 KLINE_TABLES = {tf.name: KlineTable(tf.name.lower()) for tf in TimeFrame}
 
+# the files whose every row is loaded, a file is loaded again
+# only when its checksum changes. The size and the mtime of a file when it was
+# hashed let a file whose stat didn't change skip hashing
+IngestedFile = Table(
+    "ingested_file",
+    mapper_registry.metadata,
+    Column("fname", String(100), primary_key=True),
+    Column("sha256", String(64), nullable=False),
+    Column("timeframe", String(4), nullable=False),
+    Column("pid", SMALLINT, ForeignKey("market_pair.id"), nullable=False),
+    Column("n_rows", INTEGER, nullable=False),
+    Column("ingested_at", TIMESTAMP, nullable=False),
+    Column("size", BIGINT),
+    Column("mtime_ns", BIGINT),
+)
+
 
 @mapper_registry.mapped
 @define(slots=False, order=True)
 class Pair:
+    __allow_unmapped__ = True  # attrs annotations under sqlalchemy 2
     __table__ = Table(
         "market_pair",
         mapper_registry.metadata,
-        Column("id", SMALLINT, primary_key=True),
+        Column("id", SMALLINT().with_variant(INTEGER, "sqlite"), primary_key=True),
         Column("name", String(20), unique=True, nullable=False),
     )
     id: int = field(init=False)
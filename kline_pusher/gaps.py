@@ -0,0 +1,302 @@
+"""Gaps of the ingested klines and the archives covering them
+
+The opentimes of a pair and a timeframe are compared at once with the
+opentime expected after every kline, each mismatch is a range of missing
+klines. A gap is mapped to the archives that cover it: the daily archives
+of the days of a month when only a few days are missing (or the month isn't
+over yet), the monthly archive otherwise. Only these are downloaded and
+ingested again by `--repair`.
+
+A gap may also be in the archives themselves (e.g. a maintenance of the
+exchange), such gaps are reported again after a repair.
+
+>>> python gaps.py BTCUSDT -t 1m --link_fpath gaps.csv
+>>> python gaps.py --repair --derive
+"""
+from __future__ import annotations
+import time
+import argparse
+import asyncio
+import json
+import os
+import logging
+import logging.config
+from pathlib import Path
+
+import numpy as np
+from attrs import define
+from dotenv import load_dotenv
+
+import database
+import crud
+import datamodel
+import pipeline
+from aggregate import STEPS, floor, next_floor, to_millis
+from datamodel import TimeFrame
+from loader import LOADERS
+from store import KlineStore
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+BASE_URL = "http://data.binance.vision/"
+PREFIX = "data/futures/um/monthly/klines"
+DAY = STEPS[TimeFrame.DAY_1]
+# there are no daily archives of the longer timeframes
+DAILY_TIMEFRAMES = {timeframe for timeframe, step in STEPS.items() if step <= DAY}
+
+
+@define
+class Gap:
+    pair: str
+    timeframe: TimeFrame
+    start: np.datetime64  # the first missing opentime
+    end: np.datetime64  # the opentime after the gap
+
+    @property
+    def n_klines(self) -> int:
+        if self.timeframe is TimeFrame.MONTH_1:
+            months = self.end.astype("datetime64[M]") - self.start.astype(
+                "datetime64[M]"
+            )
+            return int(months.astype(np.int64))
+        return int((self.end - self.start).astype(np.int64)) // STEPS[self.timeframe]
+
+    def asdict(self) -> dict:
+        return {
+            "pair": self.pair,
+            "timeframe": self.timeframe.value,
+            "start": str(self.start),
+            "end": str(self.end),
+            "n_klines": self.n_klines,
+        }
+
+
+def find_gaps(
+    opentime: np.ndarray,
+    timeframe: TimeFrame,
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+) -> list[tuple[int, int]]:
+    """It returns the missing ranges of ordered opentimes as epoch milliseconds,
+    the edges from `start` and until `end` are checked too when they are given"""
+    millis = opentime.astype("datetime64[ms]").astype(np.int64)
+    expected = next_floor(timeframe, millis[:-1])
+    holes = np.flatnonzero(millis[1:] > expected)
+    gaps = list(zip(expected[holes].tolist(), millis[1:][holes].tolist()))
+
+    if not len(millis) and start is not None and end is not None:
+        lower = int(floor(timeframe, np.array([to_millis(start)]))[0])
+        return [(lower, to_millis(end))]
+    if start is not None and len(millis):
+        lower = int(floor(timeframe, np.array([to_millis(start)]))[0])
+        if lower < millis[0]:
+            gaps.insert(0, (lower, int(millis[0])))
+    if end is not None and len(millis):
+        after = int(next_floor(timeframe, millis[-1:])[0])
+        if after < to_millis(end):
+            gaps.append((after, to_millis(end)))
+    return gaps
+
+
+def get_archives(
+    gap: Gap,
+    base_url: str = BASE_URL,
+    prefix: str = PREFIX,
+    daily_max_days: int = 3,
+) -> list[str]:
+    """It returns the urls of the archives covering a gap"""
+    interval = gap.timeframe.value
+    dirpath = f"{base_url}{prefix.strip('/')}/{gap.pair}/{interval}"
+    monthly = f"{dirpath}/{gap.pair}-{interval}"
+    daily = monthly.replace("/monthly/", "/daily/")
+    last = gap.end - np.timedelta64(1, "ms")
+    days = np.arange(
+        gap.start.astype("datetime64[D]"),
+        last.astype("datetime64[D]") + 1,
+        dtype="datetime64[D]",
+    )
+    current = np.datetime64("today", "M")
+
+    urls = []
+    months = days.astype("datetime64[M]")
+    for month in np.unique(months):
+        month_days = days[months == month]
+        use_daily = month == current or len(month_days) <= daily_max_days
+        if use_daily and gap.timeframe in DAILY_TIMEFRAMES:
+            urls.extend(f"{daily}-{day}.zip" for day in month_days)
+        else:
+            urls.append(f"{monthly}-{month}.zip")
+    return urls
+
+
+def scan(
+    pairs: list[str],
+    timeframes: list[TimeFrame],
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+    store: KlineStore | None = None,
+) -> list[Gap]:
+    """It scans every series of the database, or of `store` when it's given"""
+    if store:
+        pids = store.read_pairs()
+    else:
+        with database.get_session() as sess:
+            pids = {pair.name: pair.id for pair in crud.MarketPair.read_all(sess)}
+    if pairs:
+        pids = {name: pids[name] for name in map(str.upper, pairs) if name in pids}
+
+    gaps = []
+    for name, pid in sorted(pids.items()):
+        for timeframe in timeframes:
+            if store:
+                opentime = store.get_series(name, timeframe).map("opentime")
+            else:
+                table = timeframe.get_mapped_table()
+                with database.get_engine().connect() as conn:
+                    opentime = crud.KlineTable.read_opentimes(conn, table, pid)
+            if not len(opentime):  # a series never ingested isn't a gap
+                continue
+            if start is not None:
+                opentime = opentime[opentime >= start]
+            if end is not None:
+                opentime = opentime[opentime < end]
+            series = [
+                Gap(name, timeframe, *np.array([lower, upper], dtype="datetime64[ms]"))
+                for lower, upper in find_gaps(opentime, timeframe, start, end)
+            ]
+            if series:
+                n_klines = sum(gap.n_klines for gap in series)
+                logger.info(
+                    f"{name} {timeframe.value}: #{len(series)} gaps, "
+                    f"#{n_klines} klines are missing"
+                )
+            gaps.extend(series)
+    return gaps
+
+
+def main(
+    pairs: list[str],
+    timeframes: list[TimeFrame],
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+    store: KlineStore | None = None,
+    base_url: str = BASE_URL,
+    prefix: str = PREFIX,
+    daily_max_days: int = 3,
+) -> tuple[list[Gap], list[str]]:
+    gaps = scan(pairs, timeframes, start, end, store)
+    urls = []
+    for gap in gaps:
+        urls.extend(get_archives(gap, base_url, prefix, daily_max_days))
+    urls = list(dict.fromkeys(urls))
+    logger.info(f"===== #{len(gaps)} gaps, #{len(urls)} archives cover them =====")
+    return gaps, urls
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Find the gaps of the klines and fetch the archives covering them"
+    )
+    parser.add_argument("pairs", nargs="*", help="pairs to scan, every pair if empty")
+    parser.add_argument(
+        "--timeframes",
+        "-t",
+        nargs="+",
+        type=TimeFrame,
+        default=list(TimeFrame),
+        help="timeframes to scan, e.g. 1m 1h",
+    )
+    parser.add_argument(
+        "--start",
+        type=np.datetime64,
+        help="the first opentime expected (YYYY-MM-DD), the gaps before the "
+        "first kline are found from it",
+    )
+    parser.add_argument(
+        "--end",
+        type=np.datetime64,
+        help="the opentime after the last one expected (YYYY-MM-DD)",
+    )
+    parser.add_argument("--store", type=Path, help="scan a store of store.py instead")
+    parser.add_argument("--base_url", default=BASE_URL)
+    parser.add_argument("--prefix", "-p", default=PREFIX, help="monthly klines prefix")
+    parser.add_argument(
+        "--daily_max_days",
+        type=int,
+        default=3,
+        help="the daily archives are fetched instead of the monthly one "
+        "when a month misses this many days or less",
+    )
+    parser.add_argument("--output", "-o", type=Path, help="json report of the gaps")
+    parser.add_argument("--link_fpath", type=Path, help="file to write the urls to")
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="download and ingest the archives by pipeline.py and scan again",
+    )
+    parser.add_argument(
+        "--derive",
+        action="store_true",
+        help="repair only 1m and derive the higher timeframes from it",
+    )
+    parser.add_argument(
+        "--loader",
+        choices=list(LOADERS),
+        help="bulk-load backend, sqlite or executemany by the database",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of processes parsing archives",
+    )
+    parser.add_argument("--env", help="env filepath", default=".env")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    load_dotenv(args.env)
+    if args.repair and args.store:
+        raise ValueError("--repair ingests into the database, not a store")
+    if args.derive:
+        args.timeframes = [TimeFrame.MINUTE_1]
+
+    store = KlineStore(args.store) if args.store else None
+    if not store:
+        kwargs = {"local_infile": True} if args.loader == "load_data" else {}
+        database.on_startup(database.get_config(), future=True, **kwargs)
+        datamodel.create_tables()
+
+    try:
+        start = time.perf_counter()
+        scan_args = (args.pairs, args.timeframes, args.start, args.end, store)
+        gaps, urls = main(*scan_args, args.base_url, args.prefix, args.daily_max_days)
+        for gap in gaps:
+            logger.info(json.dumps(gap.asdict()))
+        if args.output:
+            with open(args.output, mode="w") as f:
+                json.dump([gap.asdict() for gap in gaps], f, indent=2)
+        if args.link_fpath:
+            with open(args.link_fpath, mode="w") as f:
+                f.writelines(f"{url}\n" for url in urls)
+
+        if args.repair and urls:
+            asyncio.run(
+                pipeline.main(
+                    urls,
+                    workers=args.workers,
+                    loader=args.loader,
+                    derive=args.derive,
+                    force=True,
+                )
+            )
+            gaps = scan(*scan_args)
+            logger.info(f"===== #{len(gaps)} gaps are left after the repair =====")
+        print(time.perf_counter() - start)
+    finally:
+        if not store:
+            database.on_shutdown()
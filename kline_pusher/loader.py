@@ -0,0 +1,152 @@
+"""Bulk-load backends of the kline tables
+
+Every backend overwrites the rows of the same `(pid, opentime)`,
+so loading a file again is safe.
+
+- `executemany`: rows as tuples to the driver's `executemany`, which pymysql
+  rewrites into multi-row `INSERT ... VALUES ... ON DUPLICATE KEY UPDATE`
+- `load_data`: `LOAD DATA LOCAL INFILE ... REPLACE` of csv rendered in memory
+  and streamed to the server through a pipe, MySQL only and it needs
+  `local_infile` on both the server and the client
+- `sqlite`: `executemany` on the sqlite3 connection for local runs and tests
+"""
+from __future__ import annotations
+import os
+import threading
+import logging
+import logging.config
+
+from sqlalchemy import Table
+from sqlalchemy.engine import Connection
+
+from datamodel import KlineBatch
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def get_upsert(conn: Connection, table: Table) -> tuple[str, list[str]]:
+    """It returns an insert overwriting the row of the same primary key,
+    with positional placeholders in the column order it returns"""
+    names = [column.name for column in table.columns]
+    keys = [column.name for column in table.primary_key]
+    quote = conn.dialect.identifier_preparer.quote
+    # tuples need positional placeholders, pymysql is `pyformat` but
+    # takes `%s` too, which its `executemany` batches
+    placeholder = "?" if conn.dialect.paramstyle == "qmark" else "%s"
+    stmt = (
+        f"INSERT INTO {conn.dialect.identifier_preparer.format_table(table)} "
+        f"({', '.join(map(quote, names))}) "
+        f"VALUES ({', '.join([placeholder] * len(names))})"
+    )
+    values = [quote(name) for name in names if name not in keys]
+    if conn.dialect.name == "mysql":
+        # `VALUES()` keeps the statement in the form pymysql batches
+        updates = ", ".join(f"{name} = VALUES({name})" for name in values)
+        return f"{stmt} ON DUPLICATE KEY UPDATE {updates}", names
+    if conn.dialect.name in {"sqlite", "postgresql"}:
+        updates = ", ".join(f"{name} = excluded.{name}" for name in values)
+        keys = ", ".join(map(quote, keys))
+        conflict = f"ON CONFLICT ({keys}) DO UPDATE SET {updates}"
+        return f"{stmt} {conflict}", names
+    return stmt, names
+
+
+class Loader:
+    name = ""
+    dialects: set[str] = set()  # every dialect if empty
+
+    def supports(self, conn: Connection) -> bool:
+        return not self.dialects or conn.dialect.name in self.dialects
+
+    def load(self, conn: Connection, table: Table, batches: list[KlineBatch]):
+        raise NotImplementedError
+
+
+class ExecutemanyLoader(Loader):
+    name = "executemany"
+
+    def load(self, conn: Connection, table: Table, batches: list[KlineBatch]):
+        """The rows go to `executemany` of the driver as tuples,
+        skipping the per-row parameter processing of sqlalchemy"""
+        stmt, names = get_upsert(conn, table)
+        data = [row for batch in batches for row in batch.rows(names)]
+        if data:
+            conn.exec_driver_sql(stmt, data)
+
+
+class LoadDataLoader(Loader):
+    name = "load_data"
+    dialects = {"mysql"}
+
+    def load(self, conn: Connection, table: Table, batches: list[KlineBatch]):
+        names = [column.name for column in table.columns]
+        data = b"".join(batch.to_csv(names) for batch in batches)
+        if not data:
+            return
+
+        # the driver opens the "file" by its name, a pipe lets it read
+        # the buffer without writing it to the disk
+        rfd, wfd = os.pipe()
+        errors = []
+
+        def write():
+            f = os.fdopen(wfd, mode="wb")
+            try:
+                f.write(data)
+                f.close()  # the rest of the buffer is flushed here
+            except BaseException as e:  # raised unless the statement failed
+                errors.append(e)
+            finally:
+                try:
+                    f.close()
+                except BrokenPipeError:  # the server stopped reading
+                    pass
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        try:
+            conn.exec_driver_sql(
+                f"LOAD DATA LOCAL INFILE '/dev/fd/{rfd}' "
+                f"REPLACE INTO TABLE `{table.name}` "
+                "FIELDS TERMINATED BY ',' LINES TERMINATED BY '\\n' "
+                f"({', '.join(f'`{name}`' for name in names)})"
+            )
+        finally:
+            os.close(rfd)
+            writer.join()
+        # the statement succeeded, but the server may not have read every row
+        if errors:
+            raise errors[0]
+
+
+class SQLiteLoader(Loader):
+    name = "sqlite"
+    dialects = {"sqlite"}
+
+    def load(self, conn: Connection, table: Table, batches: list[KlineBatch]):
+        stmt, names = get_upsert(conn, table)
+        data = [
+            row for batch in batches for row in batch.rows(names, text_timestamps=True)
+        ]
+        if data:
+            conn.exec_driver_sql(stmt, data)
+
+
+LOADERS = {
+    loader.name: loader
+    for loader in [ExecutemanyLoader(), LoadDataLoader(), SQLiteLoader()]
+}
+
+
+def get_loader(conn: Connection, name: str | None = None) -> Loader:
+    """It returns the named loader, or the best one for the dialect"""
+    if name:
+        loader = LOADERS[name]
+        if not loader.supports(conn):
+            raise ValueError(f"{name} doesn't support {conn.dialect.name}")
+        return loader
+    if conn.dialect.name == "sqlite":
+        return LOADERS["sqlite"]
+    return LOADERS["executemany"]
@@ -3,28 +3,29 @@ import time
 import argparse
 import logging
 import logging.config
-import glob
-import csv
-import io
+import hashlib
 import os
-import re
 import itertools
+import collections
+import queue
+import threading
 import sys
-from functools import partial
 from zipfile import ZipFile, BadZipFile
 from pathlib import Path, PurePath
-from concurrent.futures import ProcessPoolExecutor
-from typing import Iterator, NamedTuple
-from traceback import print_exc
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
 
+import numpy as np
 from dotenv import load_dotenv
 
 import database
 import crud
 import datamodel
+import aggregate
+from loader import LOADERS, get_loader
 from datamodel import (
     KlineZipFile,
-    KlineRecord,
+    KlineBatch,
     TimeFrame,
     Pair,
 )
@@ -34,23 +35,35 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 
-def get_pairs(dirpath: Path) -> list[Pair]:
-    get_pair = lambda x: x.split("-")[0].split("_")[0]
-    paths = map(PurePath, glob.glob(os.path.join(dirpath, "*")))
-    names = map(lambda x: x.name, paths)
-    pairs = set(map(get_pair, names))
-    return sorted(map(Pair, pairs))
+ZipFileIndex = dict[tuple[TimeFrame, str], list[KlineZipFile]]
 
 
-class JobParam(NamedTuple):
-    timeframe: TimeFrame
-    pair: Pair
+def index_zipfiles(dirpath: Path) -> ZipFileIndex:
+    """It scans `dirpath` once and groups the kline zips by timeframe and
+    pair name, every group in date order"""
+    index, pairs = collections.defaultdict(list), {}
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".zip"):
+                continue
+            parts = entry.name.split("-")
+            name = parts[0].split("_")[0]
+            try:
+                timeframe = TimeFrame(parts[1])
+            except (IndexError, ValueError):
+                logger.info(f"{entry.name} isn't a kline file")
+                continue
+            pair = pairs.setdefault(name, Pair(name))
+            index[timeframe, name].append(KlineZipFile(entry.path, timeframe, pair))
+    for zipfiles in index.values():
+        zipfiles.sort(key=lambda zipfile: zipfile.date)
+    order = {timeframe: i for i, timeframe in enumerate(TimeFrame)}
+    return dict(sorted(index.items(), key=lambda item: (order[item[0][0]], item[0][1])))
 
-    @staticmethod
-    def get_params(dirpath: Path) -> Iterator[JobParam]:
-        pairs = get_pairs(dirpath)
-        params = itertools.product(TimeFrame, pairs)
-        return map(lambda param: JobParam(*param), params)
+
+def get_pairs(index: ZipFileIndex) -> list[Pair]:
+    names = {name for _, name in index}
+    return sorted(map(Pair, names))
 
 
 class KlineParser:
@@ -59,53 +72,150 @@ class KlineParser:
 
     def get_zipfiles(
         self,
-        dirpath: Path,
+        index: ZipFileIndex,
         timeframe: TimeFrame | None = None,
         pair: Pair | None = None,
     ) -> list[KlineZipFile]:
-        if not timeframe and not pair:
-            return os.listdir(dirpath)
-
-        ptrn = ""
-        if timeframe:
-            ptrn += f"(?=.*{timeframe.value}-)"
-        if pair:
-            ptrn += f"(?=.*{pair.name.upper()}-)"
-        r = re.compile(ptrn)
-        paths = filter(r.match, os.listdir(dirpath))
-        paths = map(partial(os.path.join, dirpath), paths)
-        return [KlineZipFile(path, timeframe, pair) for path in map(PurePath, paths)]
-
-    def zipfile2records(self, zipfile: KlineZipFile) -> list[KlineRecord]:
+        return [
+            zipfile
+            for (tf, name), zipfiles in index.items()
+            if (not timeframe or tf is timeframe)
+            and (not pair or name == pair.name.upper())
+            for zipfile in zipfiles
+        ]
+
+    def get_pid(self, zipfile: KlineZipFile) -> int:
+        pid = zipfile.pair.id
+        return pid if pid else self.pairs[zipfile.pair.name]
+
+    def read_csv(self, zipfile: KlineZipFile) -> bytes:
         try:
             with ZipFile(zipfile.fpath, mode="r") as zip:
-                with zip.open(f"{zipfile.fpath.stem}.csv", mode="r") as f:
-                    pid = zipfile.pair.id
-                    pid = pid if pid else self.pairs[zipfile.pair.name]
-                    reader = csv.reader(io.TextIOWrapper(f))
-                    rows = [KlineRecord(pid, *row) for row in reader]
-            return rows
+                return zip.read(f"{zipfile.fpath.stem}.csv")
         except BadZipFile:
             logger.info(f"{zipfile} is corrupted")
-            return []
-
-    def parse_files(
-        self, dirpath: Path, timeframe: TimeFrame, pair: Pair
-    ) -> list[KlineRecord]:
-        fpaths = self.get_zipfiles(dirpath, timeframe, pair)
-        logger.info(f"#{len(fpaths)} files are loaded")
-
-        records = list(itertools.chain(*map(self.zipfile2records, fpaths)))
-        logger.info(f"#{len(records)} records")
-        return records
-
-
-def main(dirpath: Path, max_jobs: int):
-
-    pairs = get_pairs(dirpath)
+            return b""
+
+    def zipfile2batch(self, zipfile: KlineZipFile) -> KlineBatch:
+        return KlineBatch.from_csv(
+            self.get_pid(zipfile), self.read_csv(zipfile), zipfile.fpath.name
+        )
+
+
+def sha256sum(fpath: PurePath) -> str:
+    hasher = hashlib.sha256()
+    with open(fpath, mode="rb") as f:
+        while chunk := f.read(2**20):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def iter_batches(
+    executor: Executor,
+    parser: KlineParser,
+    zipfiles: list[KlineZipFile],
+    max_jobs: int,
+) -> Iterator[KlineBatch]:
+    """It parses every zip by its own task in order, with at most `max_jobs`
+    files parsed ahead of the consumer, so parsing never outruns inserting"""
+    zipfiles = iter(zipfiles)
+    submit = lambda zipfile: executor.submit(parser.zipfile2batch, zipfile)
+    pending = collections.deque(map(submit, itertools.islice(zipfiles, max_jobs)))
+    while pending:
+        batch = pending.popleft().result()
+        pending.extend(map(submit, itertools.islice(zipfiles, 1)))
+        yield batch
+
+
+def chunk_batches(
+    batches: Iterable[KlineBatch], batch_rows: int
+) -> Iterator[list[KlineBatch]]:
+    """It regroups batches into chunks of `batch_rows` rows,
+    a file larger than that is split over several chunks"""
+    chunk, size = [], 0
+    for batch in batches:
+        start = 0
+        while start < len(batch):
+            stop = min(len(batch), start + batch_rows - size)
+            chunk.append(batch[start:stop])
+            size += stop - start
+            start = stop
+            if size == batch_rows:
+                yield chunk
+                chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+class Writers:
+    """Threads inserting chunks on their own pooled connections, fed by bounded
+    queues. The chunks of a table and a pair always go to the same writer,
+    so writers never contend for the same rows and the chunks of a file are
+    inserted in order."""
+
+    def __init__(
+        self,
+        write: Callable[[TimeFrame, list[KlineBatch]], None],
+        n_writers: int,
+        queue_size: int,
+    ) -> None:
+        self.write = write
+        self.queues = [queue.Queue(queue_size) for _ in range(n_writers)]
+        self.partitions = {}
+        self.errors: list[Exception] = []
+        self.threads = [
+            threading.Thread(target=self.run, args=(q,), daemon=True)
+            for q in self.queues
+        ]
+
+    def __enter__(self) -> Writers:
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors and exc_info[0] is None:
+            raise RuntimeError(f"#{len(self.errors)} chunks failed") from self.errors[0]
+
+    def put(self, timeframe: TimeFrame, chunk: list[KlineBatch]):
+        """It blocks while the writer of the chunk is behind"""
+        key = (timeframe, chunk[0].pid)
+        i = self.partitions.setdefault(key, len(self.partitions) % len(self.queues))
+        self.queues[i].put((timeframe, chunk))
+
+    def run(self, q: queue.Queue):
+        """A failed chunk doesn't stop the writer, the failures are raised
+        once every queue is drained"""
+        while (item := q.get()) is not None:
+            try:
+                self.write(*item)
+            except Exception as e:
+                logger.exception(f"a chunk of {item[0].value} failed")
+                self.errors.append(e)
+
+
+def main(
+    dirpath: Path,
+    max_jobs: int,
+    workers: int | None = None,
+    batch_rows: int = 100_000,
+    loader: str | None = None,
+    derive: bool = False,
+    writers: int = 4,
+    queue_size: int = 2,
+):
+
+    index = index_zipfiles(dirpath)
+    pairs = get_pairs(index)
     logger.info(f"#{len(pairs)} MarketPairs are loaded")
 
     with database.get_session() as sess:
+        names = {pair.name for pair in crud.MarketPair.read_all(sess)}
+        pairs = [pair for pair in pairs if pair.name not in names]
         try:
             crud.MarketPair.create(sess, pairs)
             logger.info(f"#{len(pairs)} MarketPairs are inserted")
@@ -118,33 +228,116 @@ def main(dirpath: Path, max_jobs: int):
         pairs = crud.MarketPair.read_all(sess)
 
     parser = KlineParser(pairs)
-
-    by_time = lambda x: x.timeframe  # tables are managed by timeframe
-    for timeframe, params in itertools.groupby(JobParam.get_params(dirpath), by_time):
-        logger.info(f"handle `{timeframe.name}` timeframe data")
-
-        funcs = [partial(parser.parse_files, dirpath, *param) for param in params]
-        while funcs:
-            num_jobs = min(max_jobs, len(funcs))
-            jobs = [funcs.pop(0) for _ in range(num_jobs)]
-            logger.info(f"#{len(jobs)} jobs are created")
-
-            # with ProcessPoolExecutor(4) as executor:
-            #     futures = [executor.submit(job) for job in jobs]
-            # results = [future.result() for future in futures]
-
-            results = [job() for job in jobs]
-            records = list(itertools.chain(*results))
-            logger.info(f"#{len(records)} will be inserted")
-
-            table = timeframe.get_mapped_table()
+    with database.get_engine().connect() as conn:
+        get_loader(conn, loader)  # an unsupported backend fails before parsing
+        ledger = crud.Ledger.read_stats(conn)
+        if conn.dialect.name == "sqlite":  # a single writer at a time
+            writers = 1
+
+    # the higher timeframes are built from 1m instead of their own files
+    timeframes = [TimeFrame.MINUTE_1] if derive else list(TimeFrame)
+    zipfiles = [
+        zipfile
+        for timeframe in timeframes
+        for zipfile in parser.get_zipfiles(index, timeframe)
+    ]
+    sizes, remaining = {}, {}  # rows of a file, rows not inserted yet
+    spans = {}  # the first and the last opentime of a pair
+
+    def count(batches: Iterable[KlineBatch]) -> Iterator[KlineBatch]:
+        for batch in batches:
+            sizes[batch.fname] = remaining[batch.fname] = len(batch)
+            if len(batch):
+                opentime = batch.columns["opentime"]
+                first, last = spans.get(batch.pid, (opentime[0], opentime[-1]))
+                spans[batch.pid] = (min(first, opentime[0]), max(last, opentime[-1]))
+            yield batch
+
+    def write(timeframe: TimeFrame, chunk: list[KlineBatch]):
+        logger.info(f"#{sum(map(len, chunk))} will be inserted")
+        table = timeframe.get_mapped_table()
+        pending = collections.Counter()
+        for batch in chunk:
+            pending[batch.fname] += len(batch)
+        with database.get_engine().begin() as conn:
+            crud.KlineTable.insert_batches(conn, table, chunk, loader)
+            # a file is recorded with its last rows, only the writer of
+            # its pair touches its counter
+            for fname, n_rows in pending.items():
+                if remaining[fname] != n_rows:
+                    continue
+                fpath = Path(dirpath, fname)
+                crud.Ledger.record(
+                    conn,
+                    fname,
+                    checksums[fpath],
+                    timeframe.value,
+                    chunk[0].pid,
+                    sizes[fname],
+                    stats[fpath].st_size,
+                    stats[fpath].st_mtime_ns,
+                )
+        # the rows count as inserted once committed, a failed chunk leaves
+        # its files out of the ledger
+        for fname, n_rows in pending.items():
+            remaining[fname] -= n_rows
+
+    with ProcessPoolExecutor(workers) as executor:
+        # only a file whose size or mtime differs from the ledger is hashed
+        fpaths = [zipfile.fpath for zipfile in zipfiles]
+        stats = {fpath: os.stat(fpath) for fpath in fpaths}
+        recorded = {fname: sha256 for fname, (sha256, *_) in ledger.items()}
+        checksums, changed = {}, []
+        for fpath in fpaths:
+            stat = stats[fpath]
+            if ledger.get(fpath.name, (None,))[1:] == (stat.st_size, stat.st_mtime_ns):
+                checksums[fpath] = recorded[fpath.name]
+            else:
+                changed.append(fpath)
+        checksums.update(zip(changed, executor.map(sha256sum, changed)))
+        touched = [f for f in changed if recorded.get(f.name) == checksums[f]]
+        if touched:  # the same content, its new stat saves the next hash
+            with database.get_engine().begin() as conn:
+                for fpath in touched:
+                    stat = stats[fpath]
+                    crud.Ledger.update_stat(
+                        conn, fpath.name, stat.st_size, stat.st_mtime_ns
+                    )
+        zipfiles = [
+            zipfile
+            for zipfile in zipfiles
+            if recorded.get(zipfile.fpath.name) != checksums[zipfile.fpath]
+        ]
+        skipped = len(fpaths) - len(zipfiles)
+        logger.info(f"#{len(changed)} files are hashed")
+        if not zipfiles:
+            logger.info(f"every file is up to date, #{skipped} files")
+            return
+        logger.info(
+            f"#{len(zipfiles)} files will be ingested by {writers} writers "
+            f"(#{skipped} files are already ingested)"
+        )
+
+        # files are parsed ahead while the writers insert the previous ones
+        batches = count(iter_batches(executor, parser, zipfiles, max_jobs))
+        timeframe_of = {zipfile.fpath.name: zipfile.timeframe for zipfile in zipfiles}
+        with Writers(write, writers, queue_size) as scheduler:
+            partitions = itertools.groupby(
+                batches, key=lambda batch: (timeframe_of[batch.fname], batch.pid)
+            )
+            for (timeframe, _), group in partitions:
+                for chunk in chunk_batches(group, batch_rows):
+                    scheduler.put(timeframe, chunk)
+
+    if derive:
+
+        def update(pid: int, first: np.datetime64, last: np.datetime64) -> int:
             with database.get_engine().begin() as conn:
-                try:
-                    crud.KlineTable.insert_bulk(conn, table, records)
-                    conn.commit()
-                except Exception as e:
-                    print_exc()
-                    conn.rollback()
+                return aggregate.update(conn, pid, first, last, loader)
+
+        with ThreadPoolExecutor(writers) as pool:
+            for n_rows in pool.map(update, spans, *zip(*spans.values())):
+                logger.info(f"#{n_rows} klines of higher timeframes are derived")
 
 
 def get_args() -> argparse.Namespace:
@@ -154,7 +347,48 @@ def get_args() -> argparse.Namespace:
         "--max_jobs",
         type=int,
         default=4,
-        help="the number of maximum jobs of each loop",
+        help="the number of files parsed ahead of the inserts",
+    )
+    parser.add_argument(
+        "--batch_rows",
+        type=int,
+        default=100_000,
+        help="the number of rows loaded in a statement and a transaction, "
+        "the memory is bounded by it and max_jobs files",
+    )
+    parser.add_argument(
+        "--loader",
+        choices=list(LOADERS),
+        help="bulk-load backend, sqlite or executemany by the database",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of processes parsing files",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=4,
+        help="the number of connections inserting in parallel, one on sqlite",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=2,
+        help="the number of chunks buffered for a writer",
+    )
+    parser.add_argument(
+        "--derive",
+        action="store_true",
+        help="ingest only the 1m files and derive the higher timeframes from them",
+    )
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="drop every table and ingest every file again",
     )
     parser.add_argument("--env", help="env filepath", default=".env")
     return parser.parse_args()
@@ -164,13 +398,25 @@ if __name__ == "__main__":
     args = get_args()
     load_dotenv(args.env)
 
-    database.on_startup(database.DBConfig.from_env(), future=True)
-    datamodel.drop_tables()
+    kwargs = {"local_infile": True} if args.loader == "load_data" else {}
+    database.on_startup(database.get_config(), future=True, **kwargs)
+    if args.reset:
+        datamodel.drop_tables()
     datamodel.create_tables()
 
-    start = time.perf_counter()
-    main(args.dirpath, args.max_jobs)
-    finish = time.perf_counter()
-    print(finish - start)
-
-    database.on_shutdown()
+    try:
+        start = time.perf_counter()
+        main(
+            args.dirpath,
+            args.max_jobs,
+            args.workers,
+            args.batch_rows,
+            args.loader,
+            args.derive,
+            args.writers,
+            args.queue_size,
+        )
+        finish = time.perf_counter()
+        print(finish - start)
+    finally:
+        database.on_shutdown()
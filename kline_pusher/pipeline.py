@@ -0,0 +1,472 @@
+"""Download → validate → ingest in one process
+
+Every archive is streamed to the disk and hashed on the way, checked against
+its `.CHECKSUM`, parsed in a process pool and inserted while the other
+archives are still downloading. The stages are connected by bounded queues,
+so a slow database holds the downloads back instead of piling archives up.
+The archives are kept in `--keep_dir`, or in a temporary directory removed
+as soon as they are parsed. The downloads share the retries and the adaptive
+concurrency of the downloader, `common/controller.py`.
+
+With a manifest, the archives it records as valid on the disk are ingested
+from there and the downloaded ones are left to the validator.
+
+>>> python pipeline.py links.csv --keep_dir ./valid --manifest manifest.db
+"""
+from __future__ import annotations
+import time
+import argparse
+import asyncio
+import hashlib
+import logging
+import logging.config
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePath
+from typing import Awaitable, Callable, TypeVar
+from urllib.parse import urlparse
+
+import aiohttp
+import aiofiles
+import aiofiles.os
+from attrs import define, field
+from dotenv import load_dotenv
+
+import database
+import crud
+import datamodel
+import aggregate
+from datamodel import KlineZipFile, KlineBatch, Pair, TimeFrame
+from main import KlineParser, chunk_batches
+from loader import LOADERS
+from common.controller import (
+    CHECKSUM_SUFFIX,
+    ChecksumError,
+    Controller,
+    fetch_checksum,
+    get_backoff,
+    is_retryable,
+    ttfb_trace_config,
+)
+from common.manifest import Manifest, Artifact, Status
+from common.transfer import get_part_fpath, stream_to_part
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+
+async def fetch_verified(
+    sess: aiohttp.ClientSession, url: str, fpath: Path, checksum: str
+) -> int:
+    """It streams an archive to `fpath` through a `.part` file a chunk at a
+    time and checks its sha256 on the way, so only a chunk is in memory. A
+    retry resumes from the bytes of the `.part` file like the downloader."""
+    part_fpath = get_part_fpath(fpath)
+    hasher = hashlib.sha256()
+    size = await stream_to_part(sess, url, part_fpath, hasher=hasher)
+    if hasher.hexdigest() != checksum:
+        await aiofiles.os.remove(part_fpath)
+        raise ChecksumError(f"{fpath.name} is failed {checksum}/{hasher.hexdigest()}")
+    await aiofiles.os.replace(part_fpath, fpath)
+    return size
+
+
+def insert_batch(
+    zipfile: KlineZipFile,
+    batch: KlineBatch,
+    checksum: str,
+    batch_rows: int,
+    loader: str | None = None,
+    derive: bool = False,
+):
+    table = zipfile.timeframe.get_mapped_table()
+    with database.get_engine().begin() as conn:
+        for chunk in chunk_batches([batch], batch_rows):
+            crud.KlineTable.insert_batches(conn, table, chunk, loader)
+        crud.Ledger.record(
+            conn,
+            zipfile.fpath.name,
+            checksum,
+            zipfile.timeframe.value,
+            batch.pid,
+            len(batch),
+        )
+        if derive and zipfile.timeframe is TimeFrame.MINUTE_1 and len(batch):
+            opentime = batch.columns["opentime"]
+            aggregate.update(conn, batch.pid, opentime[0], opentime[-1], loader)
+
+
+def get_or_create_pair(name: str) -> Pair:
+    with database.get_session() as sess:
+        pair = crud.MarketPair.read(sess, name)
+        if pair is None:
+            crud.MarketPair.create(sess, Pair(name))
+            sess.commit()
+            pair = crud.MarketPair.read(sess, name)
+        return pair
+
+
+@define
+class Progress:
+    total: int
+    downloaded: int = 0
+    ingested: int = 0
+    failed: int = 0
+    records: int = 0
+    started_at: float = field(factory=time.monotonic)
+
+    def log(self):
+        done = self.ingested + self.failed
+        if done % 10 and done != self.total:
+            return
+        elapsed = time.monotonic() - self.started_at
+        logger.info(
+            f"===== {done}/{self.total} files, "
+            f"#{self.records} records in {elapsed:.1f} sec "
+            f"({self.failed} failed) ====="
+        )
+
+
+@define
+class Pipeline:
+    sess: aiohttp.ClientSession
+    controller: Controller
+    executor: ProcessPoolExecutor
+    parser: KlineParser
+    progress: Progress
+    work_dir: Path  # the keep dir or a temporary one
+    keep_dir: Path | None = None
+    manifest: Manifest | None = None
+    max_retries: int = 5
+    batch_rows: int = 100_000
+    loader: str | None = None
+    ledger: dict[str, str] = field(factory=dict)  # sha256 by ingested file
+    derive: bool = False
+    local: dict[str, Artifact] = field(factory=dict)  # valid archives on the disk
+    pair_lock: asyncio.Lock = field(factory=asyncio.Lock)
+
+    def record(self, url: str, status: Status, **values):
+        if self.manifest:
+            self.manifest.update(url, status, **values)
+
+    def fail(self, url: str, e: BaseException):
+        logger.info(f"{os.path.basename(url)} is failed: {e!r}")
+        self.record(url, Status.FAILED, failure=True)
+        self.progress.failed += 1
+        self.progress.log()
+
+    def discard(self, zipfile: KlineZipFile):
+        """A temporary archive is removed once it is parsed or failed"""
+        if not self.keep_dir and zipfile.fpath.parent == self.work_dir:
+            Path(zipfile.fpath).unlink(missing_ok=True)
+
+    async def retry(self, fetch: Callable[..., Awaitable[T]], *args) -> T:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.controller:
+                    return await fetch(self.sess, *args)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                # a corrupted archive isn't a sign of load, no backoff
+                if not isinstance(e, ChecksumError):
+                    await asyncio.sleep(get_backoff(attempt))
+
+    async def downloader(self, urls: asyncio.Queue, parsing: asyncio.Queue):
+        while True:
+            url = await urls.get()
+            try:
+                artifact = self.local.get(url)
+                if artifact:  # validated before, nothing to fetch
+                    fpath, checksum = Path(artifact.fpath), artifact.sha256
+                else:
+                    fpath = Path(self.work_dir, PurePath(urlparse(url).path).name)
+                    self.record(url, Status.DOWNLOADING, attempt=True)
+                    checksum = await self.retry(fetch_checksum, url)
+                if self.ledger.get(fpath.name) == checksum:  # nothing new
+                    self.record(url, Status.INGESTED, sha256=checksum)
+                    self.progress.ingested += 1
+                    self.progress.log()
+                    continue
+                if not artifact:
+                    size = await self.retry(fetch_verified, url, fpath, checksum)
+                    self.progress.downloaded += 1
+                    self.record(
+                        url,
+                        Status.VALID,
+                        size=size,
+                        fpath=str(fpath) if self.keep_dir else None,
+                        sha256=checksum,
+                    )
+                await parsing.put((url, KlineZipFile(fpath), checksum))
+            except Exception as e:
+                self.fail(url, e)
+            finally:
+                urls.task_done()
+
+    async def parse(self, parsing: asyncio.Queue, inserting: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            url, zipfile, checksum = await parsing.get()
+            try:
+                name = zipfile.pair.name
+                async with self.pair_lock:  # a new pair is created only once
+                    if name not in self.parser.pairs:
+                        pair = await loop.run_in_executor(
+                            None, get_or_create_pair, name
+                        )
+                        self.parser.pairs[name] = pair.id
+                batch = await loop.run_in_executor(
+                    self.executor, self.parser.zipfile2batch, zipfile
+                )
+                if not len(batch):
+                    raise ValueError(f"{zipfile.fpath.name} has no records")
+                await inserting.put((url, zipfile, batch, checksum))
+            except Exception as e:
+                self.fail(url, e)
+            finally:
+                self.discard(zipfile)
+                parsing.task_done()
+
+    async def insert(self, inserting: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            url, zipfile, batch, checksum = await inserting.get()
+            try:
+                await loop.run_in_executor(
+                    None,
+                    insert_batch,
+                    zipfile,
+                    batch,
+                    checksum,
+                    self.batch_rows,
+                    self.loader,
+                    self.derive,
+                )
+                self.record(url, Status.INGESTED)
+                self.progress.ingested += 1
+                self.progress.records += len(batch)
+                self.progress.log()
+            except Exception as e:
+                self.fail(url, e)
+            finally:
+                inserting.task_done()
+
+
+async def main(
+    urls: list[str],
+    limit: int = 16,
+    workers: int = 4,
+    queue_size: int = 8,
+    keep_dir: Path | None = None,
+    manifest: Manifest | None = None,
+    max_retries: int = 5,
+    batch_rows: int = 100_000,
+    loader: str | None = None,
+    derive: bool = False,
+    force: bool = False,
+    local: dict[str, Artifact] | None = None,
+):
+    """`local` are the archives validated on the disk before by their url,
+    they are ingested from there"""
+    with database.get_session() as sess:
+        parser = KlineParser(crud.MarketPair.read_all(sess))
+    ledger = {}  # every archive is ingested again when forced
+    if not force:
+        with database.get_engine().connect() as conn:
+            ledger = crud.Ledger.read_all(conn)
+
+    url_queue = asyncio.Queue()
+    for url in urls:
+        url_queue.put_nowait(url)
+    parsing, inserting = asyncio.Queue(queue_size), asyncio.Queue(queue_size)
+
+    controller = Controller(limit)
+    connector = aiohttp.TCPConnector(limit=limit, ttl_dns_cache=300)
+    trace_configs = [ttfb_trace_config(controller.on_latency)]
+    work_dir = keep_dir or Path(tempfile.mkdtemp(prefix="pipeline-"))
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, trace_configs=trace_configs
+        ) as sess:
+            with ProcessPoolExecutor(workers) as executor:
+                pipeline = Pipeline(
+                    sess,
+                    controller,
+                    executor,
+                    parser,
+                    Progress(len(urls)),
+                    work_dir,
+                    keep_dir,
+                    manifest,
+                    max_retries,
+                    batch_rows,
+                    loader,
+                    ledger,
+                    derive,
+                    local or {},
+                )
+                tasks = [
+                    *[
+                        asyncio.create_task(pipeline.downloader(url_queue, parsing))
+                        for _ in range(limit)
+                    ],
+                    *[
+                        asyncio.create_task(pipeline.parse(parsing, inserting))
+                        for _ in range(workers)
+                    ],
+                    asyncio.create_task(pipeline.insert(inserting)),
+                ]
+                # every stage is drained in order, so nothing is left in flight
+                await url_queue.join()
+                await parsing.join()
+                await inserting.join()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if not keep_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return pipeline.progress
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Download, validate and push historical data in one process"
+    )
+    parser.add_argument("links", type=Path, nargs="?", help="file download links csv")
+    parser.add_argument(
+        "--limit",
+        "-l",
+        type=int,
+        default=16,
+        help="the number of maximum concurrent downloads",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of processes parsing archives",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=8,
+        help="the number of archives buffered between two stages",
+    )
+    parser.add_argument(
+        "--keep_dir", type=Path, help="directory to keep the valid zips in"
+    )
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument(
+        "--batch_rows",
+        type=int,
+        default=100_000,
+        help="the number of rows loaded in a statement",
+    )
+    parser.add_argument(
+        "--loader",
+        choices=list(LOADERS),
+        help="bulk-load backend, sqlite or executemany by the database",
+    )
+    parser.add_argument(
+        "--derive",
+        action="store_true",
+        help="ingest only the 1m archives and derive the higher timeframes from them",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="ingest the archives again even if the ledger has their checksums",
+    )
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        type=Path,
+        help="artifact manifest db shared with the other tools",
+    )
+    parser.add_argument("--env", help="env filepath", default=".env")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    load_dotenv(args.env)
+
+    urls = []
+    if args.links:
+        with open(args.links, "r") as f:
+            urls = [line.strip() for line in f if line.strip()]
+    urls = [url for url in urls if not url.endswith(CHECKSUM_SUFFIX)]
+
+    manifest, local = None, {}
+    if args.manifest:
+        manifest = Manifest(args.manifest)
+        manifest.upsert(map(Artifact, urls))
+        # an archive valid on the disk is ingested from there, a downloaded
+        # one is left to the validator, the others are fetched
+        artifacts = manifest.select(
+            Status.LISTED,
+            Status.DOWNLOADING,
+            Status.VALID,
+            Status.FAILED,
+        )
+        local = {
+            artifact.url: artifact
+            for artifact in artifacts
+            if artifact.status is Status.VALID
+            and artifact.sha256
+            and artifact.fpath
+            and os.path.exists(artifact.fpath)
+        }
+        urls = [
+            artifact.url
+            for artifact in artifacts
+            if not artifact.url.endswith(CHECKSUM_SUFFIX)
+            and (artifact.status is not Status.VALID or artifact.url in local)
+        ]
+    if args.derive:
+        urls = [
+            url
+            for url in urls
+            if KlineZipFile(urlparse(url).path).timeframe is TimeFrame.MINUTE_1
+        ]
+    if not urls:
+        raise ValueError("No File Download Links")
+    if args.keep_dir:
+        os.makedirs(args.keep_dir, exist_ok=True)
+    logger.info(f"#{len(urls)} files will be ingested")
+
+    kwargs = {"local_infile": True} if args.loader == "load_data" else {}
+    database.on_startup(database.get_config(), future=True, **kwargs)
+    datamodel.create_tables()
+
+    try:
+        start = time.perf_counter()
+        asyncio.run(
+            main(
+                urls,
+                args.limit,
+                args.workers,
+                args.queue_size,
+                args.keep_dir,
+                manifest,
+                args.max_retries,
+                args.batch_rows,
+                args.loader,
+                args.derive,
+                args.force,
+                local,
+            )
+        )
+        print(time.perf_counter() - start)
+    finally:
+        if manifest:
+            manifest.close()
+        database.on_shutdown()
@@ -0,0 +1,286 @@
+"""Memory-mapped columnar store of klines, a sink without a database
+
+Every pair and timeframe is a directory of fixed-width little-endian arrays,
+one file by column, in opentime order:
+
+    <root>/<PAIR>/<timeframe>/
+        meta.json           the rows, the generation and the ingested files
+        opentime.<gen>.bin  datetime64[ms]
+        open.<gen>.bin      float64, and so are the other prices and volumes
+        ...
+        index.<gen>.bin     the opentime of every `INDEX_STRIDE`-th row
+
+Newer klines are appended to the files past the rows of `meta.json`, which a
+reader never maps. Older or overlapping ones are merged with the stored rows
+from the first overlapping one on, and the next generation is the rows before
+it copied as they are plus the merged tail. New files and indexes are written
+under a temporary name and renamed, then `meta.json` is replaced, so a reader
+sees either the previous rows or the new ones, never a part of them. The
+previous generation is kept until the next commit for the readers still
+mapping it. Readers get read-only views of the mapped files and a time range
+is found by a binary search of the index and then of one stride of opentimes.
+
+>>> python store.py ./valid --root ./store
+"""
+from __future__ import annotations
+import time
+import argparse
+import json
+import os
+import logging
+import logging.config
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from attrs import define, field
+
+from datamodel import KlineBatch, TimeFrame
+from main import KlineParser, get_pairs, index_zipfiles, iter_batches, sha256sum
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+# the columns of the kline tables
+DTYPES = {
+    column.name: np.dtype("<f8")
+    for column in TimeFrame.MINUTE_1.get_mapped_table().columns
+    if column.name != "pid"
+}
+DTYPES.update(opentime=np.dtype("<M8[ms]"), number_of_trade=np.dtype("<i8"))
+INDEX_STRIDE = 4096
+
+
+@define
+class Series:
+    """The klines of a pair and a timeframe"""
+
+    dirpath: Path
+    rows: int = 0
+    generation: int = 0
+    pid: int = 0
+    files: dict[str, str] = field(factory=dict)  # sha256 by ingested file
+
+    @classmethod
+    def open(cls, dirpath: Path) -> Series:
+        fpath = Path(dirpath, "meta.json")
+        if not fpath.exists():
+            return cls(dirpath)
+        return cls(dirpath, **json.loads(fpath.read_text()))
+
+    def get_fpath(self, name: str, generation: int | None = None) -> Path:
+        generation = self.generation if generation is None else generation
+        return Path(self.dirpath, f"{name}.{generation}.bin")
+
+    def map(self, name: str) -> np.ndarray:
+        dtype = DTYPES.get(name, DTYPES["opentime"])
+        rows = self.rows if name != "index" else -(-self.rows // INDEX_STRIDE)
+        if not rows:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.get_fpath(name), dtype=dtype, mode="r", shape=(rows,))
+
+    def columns(self) -> dict[str, np.ndarray]:
+        return {name: self.map(name) for name in DTYPES}
+
+    def search(self, value: np.datetime64) -> int:
+        """It returns the first row opened at `value` or later"""
+        index = np.array(self.map("index"))
+        block = max(int(np.searchsorted(index, value, side="right")) - 1, 0)
+        lower = block * INDEX_STRIDE
+        opentime = self.map("opentime")[lower : lower + INDEX_STRIDE]
+        return lower + int(np.searchsorted(opentime, value))
+
+    def read(self, start: np.datetime64, end: np.datetime64) -> KlineBatch:
+        """It returns the klines opened from `start` until `end` (exclusive)
+        as views of the mapped files"""
+        lower, upper = self.search(start), self.search(end)
+        columns = {name: column[lower:upper] for name, column in self.columns().items()}
+        return KlineBatch(self.pid, columns)
+
+    def write(self, batch: KlineBatch, fname: str = "", sha256: str = "") -> int:
+        """It appends newer klines or merges overlapping ones into the series,
+        the klines of `batch` win over the stored ones"""
+        self.pid = batch.pid
+        if len(batch):
+            lower = self.search(batch.columns["opentime"][0])
+            if lower < self.rows:
+                self.merge(batch, lower)
+            else:
+                self.append(batch)
+        if fname:
+            self.files[fname] = sha256
+        self.commit()
+        return len(batch)
+
+    def append(self, batch: KlineBatch):
+        os.makedirs(self.dirpath, exist_ok=True)
+        for name, dtype in DTYPES.items():
+            fpath = self.get_fpath(name)
+            with open(fpath, mode="r+b" if fpath.exists() else "wb") as f:
+                # the tail of an interrupted write is overwritten
+                f.seek(self.rows * dtype.itemsize)
+                f.write(np.ascontiguousarray(batch.columns[name], dtype=dtype))
+                f.truncate()
+        self.rows += len(batch)
+        self.write_index()
+
+    def merge(self, batch: KlineBatch, lower: int):
+        """It merges `batch` with the stored rows from `lower` on, the rows
+        before it aren't read"""
+        stored = self.columns()
+        tail = {name: column[lower:] for name, column in stored.items()}
+        opentime = np.concatenate([tail["opentime"], batch.columns["opentime"]])
+        order = np.argsort(opentime, kind="stable")
+        opentime = opentime[order]
+        # the last of the same opentimes is the one of `batch`
+        keep = order[np.r_[opentime[1:] != opentime[:-1], True]]
+        merged = {
+            name: np.concatenate([tail[name], batch.columns[name].astype(dtype)])[keep]
+            for name, dtype in DTYPES.items()
+        }
+
+        n_tail = self.rows - lower
+        if all(np.array_equal(merged[name][:n_tail], tail[name]) for name in DTYPES):
+            # the stored rows don't change, only the newer ones are written
+            newer = {name: column[n_tail:] for name, column in merged.items()}
+            self.append(KlineBatch(self.pid, newer))
+            return
+
+        generation = self.generation + 1
+        for name in DTYPES:
+            fpath = self.get_fpath(name, generation)
+            self.write_file(fpath, stored[name][:lower], merged[name])
+        self.rows = lower + len(keep)
+        self.generation = generation
+        self.write_index()
+
+    def write_index(self):
+        opentime = self.map("opentime")
+        self.write_file(self.get_fpath("index"), opentime[::INDEX_STRIDE])
+
+    def write_file(self, fpath: Path, *arrays: np.ndarray):
+        """It writes a file under a temporary name and renames it,
+        a reader opening it never finds it partly written"""
+        tmp_fpath = fpath.with_name(f"{fpath.name}.tmp")
+        with open(tmp_fpath, mode="wb") as f:
+            for array in arrays:
+                f.write(np.ascontiguousarray(array))
+        os.replace(tmp_fpath, fpath)
+
+    def commit(self):
+        """The rows written before are visible to the readers from now on"""
+        meta = {
+            "rows": self.rows,
+            "generation": self.generation,
+            "pid": self.pid,
+            "files": self.files,
+        }
+        os.makedirs(self.dirpath, exist_ok=True)
+        fpath = Path(self.dirpath, "meta.json")
+        # a reader may still map the generation of the replaced meta
+        previous = self.generation
+        if fpath.exists():
+            previous = json.loads(fpath.read_text())["generation"]
+        tmp_fpath = fpath.with_suffix(".tmp")
+        tmp_fpath.write_text(json.dumps(meta))
+        os.replace(tmp_fpath, fpath)
+        for old in self.dirpath.glob("*.bin"):
+            if int(old.stem.rpartition(".")[2]) not in {self.generation, previous}:
+                old.unlink()
+
+
+@define
+class KlineStore:
+    root: Path = field(converter=Path)
+
+    def get_series(self, pair: str, timeframe: TimeFrame) -> Series:
+        return Series.open(Path(self.root, pair.upper(), timeframe.value))
+
+    def read_range(
+        self,
+        pair: str,
+        timeframe: TimeFrame,
+        start: np.datetime64 | str,
+        end: np.datetime64 | str,
+    ) -> KlineBatch:
+        """It reads the klines of a pair opened from `start` until `end`
+        (exclusive) as read-only NumPy views"""
+        series = self.get_series(pair, timeframe)
+        return series.read(np.datetime64(start, "ms"), np.datetime64(end, "ms"))
+
+    def read_pairs(self) -> dict[str, int]:
+        """It returns the id of every stored pair by its name"""
+        return {
+            fpath.parent.parent.name: json.loads(fpath.read_text())["pid"]
+            for fpath in self.root.glob("*/*/meta.json")
+        }
+
+    def read_ledger(self) -> dict[str, str]:
+        """It returns the sha256 of every ingested file by its name"""
+        ledger = {}
+        for fpath in self.root.glob("*/*/meta.json"):
+            ledger.update(json.loads(fpath.read_text())["files"])
+        return ledger
+
+
+def main(dirpath: Path, root: Path, max_jobs: int, workers: int | None = None):
+    index = index_zipfiles(dirpath)
+    store = KlineStore(root)
+
+    # the store has no pair table, a new pair takes the next id
+    parser = KlineParser([])
+    parser.pairs = store.read_pairs()
+    for pair in get_pairs(index):
+        parser.pairs.setdefault(pair.name, max(parser.pairs.values(), default=0) + 1)
+
+    ledger = store.read_ledger()
+    zipfiles = [zipfile for zipfiles in index.values() for zipfile in zipfiles]
+    with ProcessPoolExecutor(workers) as executor:
+        fpaths = [zipfile.fpath for zipfile in zipfiles]
+        checksums = dict(zip(fpaths, executor.map(sha256sum, fpaths)))
+        zipfiles = [
+            zipfile
+            for zipfile in zipfiles
+            if ledger.get(zipfile.fpath.name) != checksums[zipfile.fpath]
+        ]
+        logger.info(
+            f"#{len(zipfiles)} files will be stored "
+            f"(#{len(fpaths) - len(zipfiles)} files are already stored)"
+        )
+
+        n_rows = 0
+        batches = iter_batches(executor, parser, zipfiles, max_jobs)
+        for zipfile, batch in zip(zipfiles, batches):
+            series = store.get_series(zipfile.pair.name, zipfile.timeframe)
+            n_rows += series.write(batch, batch.fname, checksums[zipfile.fpath])
+        logger.info(f"===== #{n_rows} klines are stored =====")
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Store historical data in memory-mapped columnar files"
+    )
+    parser.add_argument("dirpath", help="Historical Data Dir Path")
+    parser.add_argument("--root", type=Path, required=True, help="store directory")
+    parser.add_argument(
+        "--max_jobs",
+        type=int,
+        default=4,
+        help="the number of files parsed ahead of the writes",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of processes parsing files",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    start = time.perf_counter()
+    main(args.dirpath, args.root, args.max_jobs, args.workers)
+    print(time.perf_counter() - start)
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the modules of kline_pusher are imported as siblings, as by `python main.py`,
+# and `common` from the root of the repository
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT.parent)]
@@ -0,0 +1,131 @@
+from __future__ import annotations
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pymysql
+import pymysql.cursors
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql.pymysql import MySQLDialect_pymysql
+
+import datamodel
+import loader
+from datamodel import KlineBatch, TimeFrame
+
+
+class RecordingCursor(pymysql.cursors.Cursor):
+    """A pymysql cursor keeping the statements it would send to the server"""
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.queries = []
+
+    def execute(self, query, args=None):
+        if args is not None:
+            query = self.mogrify(query, args)
+        self.queries.append(query if isinstance(query, str) else query.decode())
+        return 1
+
+
+def get_batch(pid: int = 1, n_rows: int = 3) -> KlineBatch:
+    opentime = np.arange(n_rows, dtype=np.int64).astype("datetime64[m]")
+    columns = {
+        name: np.arange(n_rows, dtype=np.float64) for name in datamodel.KLINE_COLUMNS
+    }
+    columns.update(
+        opentime=opentime.astype("datetime64[ms]"),
+        closetime=(opentime + 1).astype("datetime64[ms]") - 1,
+        number_of_trade=np.arange(n_rows, dtype=np.int64),
+    )
+    return KlineBatch(pid, columns)
+
+
+@pytest.fixture
+def mysql_conn():
+    """A connection of the MySQL dialect executing on a recording pymysql cursor"""
+    cursor = RecordingCursor(pymysql.connections.Connection(defer_connect=True))
+    return SimpleNamespace(
+        dialect=MySQLDialect_pymysql(),
+        cursor=cursor,
+        exec_driver_sql=lambda stmt, data: cursor.executemany(stmt, data),
+    )
+
+
+def test_mysql_upsert_is_batched_by_pymysql(mysql_conn):
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    stmt, names = loader.get_upsert(mysql_conn, table)
+
+    assert names == [column.name for column in table.columns]
+    assert pymysql.cursors.RE_INSERT_VALUES.match(stmt)
+    assert "ON DUPLICATE KEY UPDATE open = VALUES(open)," in stmt
+
+
+def test_mysql_executemany_loader(mysql_conn):
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    loader.ExecutemanyLoader().load(mysql_conn, table, [get_batch(n_rows=3)])
+
+    # a single multi-row insert with the values in the column order
+    [query] = mysql_conn.cursor.queries
+    assert query.startswith("INSERT INTO minute_1 (pid, opentime, open,")
+    assert "VALUES (1, '1970-01-01 00:00:00', 0.0e0," in query
+    assert "),(1, '1970-01-01 00:02:00', 2.0e0," in query
+    assert query.endswith("= VALUES(taker_buy_quote_asset_volume)")
+
+
+def test_sqlite_loader_overwrites_rows():
+    engine = sa.create_engine("sqlite://")
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    table.metadata.create_all(engine, tables=[table])
+    batch = get_batch(n_rows=3)
+    with engine.begin() as conn:
+        loader.SQLiteLoader().load(conn, table, [batch])
+        batch.columns["close"] = batch.columns["close"] + 10
+        loader.SQLiteLoader().load(conn, table, [batch[1:]])
+        rows = conn.execute(sa.select(table.c.close).order_by(table.c.opentime))
+        assert [row.close for row in rows] == [0.0, 11.0, 12.0]
+
+
+def read_infile(stmt: str, limit: int = -1) -> bytes:
+    """It reads the pipe named by a `LOAD DATA LOCAL INFILE` statement"""
+    fd = int(stmt.split("'/dev/fd/")[1].split("'")[0])
+    with os.fdopen(os.dup(fd), mode="rb") as f:
+        return f.read(limit)
+
+
+def test_load_data_streams_every_row():
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    batch = get_batch(n_rows=5000)  # larger than the pipe buffer
+    received = []
+    conn = SimpleNamespace(
+        exec_driver_sql=lambda stmt: received.append(read_infile(stmt))
+    )
+    loader.LoadDataLoader().load(conn, table, [batch])
+
+    names = [column.name for column in table.columns]
+    assert received == [batch.to_csv(names)]
+
+
+class LateThread(threading.Thread):
+    """It runs its target only when joined, once the pipe is closed"""
+
+    def start(self):
+        pass
+
+    def join(self, timeout=None):
+        self.run()
+
+
+@pytest.mark.parametrize("n_rows", [3, 5000])
+def test_load_data_raises_the_server_error(monkeypatch, n_rows):
+    def execute(stmt):  # the server fails without reading every row
+        read_infile(stmt, 16)
+        raise pymysql.err.OperationalError(1406, "Data too long")
+
+    # the rows are written (3) or flushed on close (5000) to a closed pipe
+    monkeypatch.setattr(loader, "threading", SimpleNamespace(Thread=LateThread))
+    table = TimeFrame.MINUTE_1.get_mapped_table()
+    conn = SimpleNamespace(exec_driver_sql=execute)
+    with pytest.raises(pymysql.err.OperationalError, match="Data too long"):
+        loader.LoadDataLoader().load(conn, table, [get_batch(n_rows=n_rows)])
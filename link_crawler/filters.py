@@ -0,0 +1,92 @@
+from __future__ import annotations
+import calendar
+import dataclasses as dc
+import datetime as dt
+import re
+from fnmatch import fnmatchcase
+
+# the values of `TimeFrame` in kline_pusher/datamodel.py
+INTERVALS = [
+    '1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '8h', '12h', '1d',
+    '3d', '1w', '1mo'
+]
+PERIOD_PTRN = re.compile(r'-(\d{4})-(\d{2})(?:-(\d{2}))?\.zip')
+
+
+def get_period(key: str) -> tuple[dt.date, dt.date] | None:
+    '''It returns the first and the last day covered by a monthly or daily file
+    '''
+    match = PERIOD_PTRN.search(key)
+    if not match:
+        return None
+    year, month, day = match.groups()
+    year, month = int(year), int(month)
+    if day:
+        date = dt.date(year, month, int(day))
+        return date, date
+    last_day = calendar.monthrange(year, month)[1]
+    return dt.date(year, month, 1), dt.date(year, month, last_day)
+
+
+@dc.dataclass
+class PrefixFilter:
+    '''It decides which prefixes and files under `<root>/<SYMBOL>/<interval>/`
+    are crawled, so subtrees that can't match are never listed
+    '''
+    symbols: list[str] = dc.field(default_factory=list)  # exact or glob
+    exclude_symbols: list[str] = dc.field(default_factory=list)
+    intervals: list[str] = dc.field(default_factory=list)
+    start: dt.date | None = None
+    end: dt.date | None = None
+
+    def __post_init__(self):
+        self.symbols = [symbol.upper() for symbol in self.symbols]
+        self.exclude_symbols = [symbol.upper() for symbol in self.exclude_symbols]
+
+    def match_symbol(self, symbol: str) -> bool:
+        symbol = symbol.upper()
+        if any(fnmatchcase(symbol, ptrn) for ptrn in self.exclude_symbols):
+            return False
+        if not self.symbols:
+            return True
+        return any(fnmatchcase(symbol, ptrn) for ptrn in self.symbols)
+
+    def match_interval(self, interval: str) -> bool:
+        if not self.intervals or interval not in INTERVALS:
+            return True
+        return interval in self.intervals
+
+    def match_prefix(self, root: str, prefix: str) -> bool:
+        parts = prefix[len(root):].strip('/').split('/')
+        if parts[0] and not self.match_symbol(parts[0]):
+            return False
+        if len(parts) > 1 and not self.match_interval(parts[1]):
+            return False
+        return True
+
+    def match_file(self, key: str) -> bool:
+        period = get_period(key)
+        if not period:
+            return True
+        first_day, last_day = period
+        if self.start and last_day < self.start:
+            return False
+        if self.end and first_day > self.end:
+            return False
+        return True
+
+    def get_start_after(self, prefix: str) -> str | None:
+        '''It returns the key to start listing a `<SYMBOL>/<interval>/` prefix
+        from the month of `start`, at any depth of the bucket
+        '''
+        parts = prefix.strip('/').split('/')
+        if not self.start or len(parts) < 2 or parts[-1] not in INTERVALS:
+            return None
+        symbol, interval = parts[-2:]
+        return f'{prefix}{symbol}-{interval}-{self.start:%Y-%m}'
+
+    def is_over(self, key: str) -> bool:
+        '''It tells whether a file and every file listed after it is past `end`
+        '''
+        period = get_period(key)
+        return bool(self.end and period and period[0] > self.end)
@@ -0,0 +1,369 @@
+from __future__ import annotations
+import asyncio
+import dataclasses as dc
+import datetime as dt
+import json
+import logging
+import logging.config
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import aiohttp
+
+from filters import PrefixFilter, get_period
+from common.manifest import Artifact
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+LISTING_URL = 'https://s3-ap-northeast-1.amazonaws.com/data.binance.vision'
+S3_NS = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+
+
+@dc.dataclass
+class ListingPage:
+    files: list[Artifact]
+    prefixes: list[str]
+    token: str | None = None
+
+    @staticmethod
+    def from_xml(text: str, base_url: str) -> ListingPage:
+        '''It parses a `ListObjectsV2` page, `NextMarker` is used
+        when a bucket answers with a `ListObjects` page
+        '''
+        root = ET.fromstring(text)
+        findtext = lambda node, tag: node.findtext(f's3:{tag}', None, S3_NS)
+
+        files = []
+        for node in root.iterfind('s3:Contents', S3_NS):
+            key = findtext(node, 'Key')
+            if not ListingPage.is_filelink(key):
+                continue
+            size = findtext(node, 'Size')
+            etag = findtext(node, 'ETag')
+            files.append(
+                Artifact(url=f'{base_url}{key}',
+                         size=int(size) if size else None,
+                         last_modified=findtext(node, 'LastModified'),
+                         etag=etag.strip('"') if etag else None))
+
+        prefixes = [
+            findtext(node, 'Prefix')
+            for node in root.iterfind('s3:CommonPrefixes', S3_NS)
+        ]
+
+        token = None
+        if findtext(root, 'IsTruncated') == 'true':
+            token = findtext(root, 'NextContinuationToken') or \
+                    findtext(root, 'NextMarker')
+            if not token and files:  # `ListObjects` may omit `NextMarker`
+                token = files[-1].url[len(base_url):]
+        return ListingPage(files, prefixes, token)
+
+    @staticmethod
+    def is_filelink(key: str) -> bool:
+        return '.zip' in key
+
+
+def is_closed(key: str, today: dt.date | None = None) -> bool:
+    '''It tells whether the month or the day of a file is over,
+    a file of a closed period is never published again
+    '''
+    period = get_period(key)
+    if not period:
+        return False
+    today = today or dt.datetime.now(dt.timezone.utc).date()
+    return period[1] < today
+
+
+@dc.dataclass
+class CachedPrefix:
+    prefix: str
+    listed_at: float
+    is_leaf: bool
+    children: list[str]
+    # the key a leaf is listed after, '' from its first key,
+    # None when unknown (cached before it was recorded)
+    listed_from: str | None = None
+
+    def covers(self, start_after: str | None) -> bool:
+        '''It tells whether the cached files of a leaf go back to `start_after`
+        '''
+        if self.listed_from is None:
+            return False
+        return not self.listed_from or (start_after or '') >= self.listed_from
+
+
+class ListingCache:
+    '''SQLite cache of the last listings, every listed prefix is committed
+    at once so a crashed crawl resumes from the prefixes it has not listed
+    '''
+    schema = '''
+    CREATE TABLE IF NOT EXISTS crawl (
+        id INTEGER PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        finished_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS prefix (
+        prefix TEXT PRIMARY KEY,
+        listed_at REAL NOT NULL,
+        is_leaf INTEGER NOT NULL,
+        children TEXT NOT NULL,
+        listed_from TEXT
+    );
+    CREATE TABLE IF NOT EXISTS file (
+        key TEXT PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        size INTEGER,
+        last_modified TEXT,
+        etag TEXT,
+        changed_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS file_prefix ON file (prefix);
+    CREATE INDEX IF NOT EXISTS file_changed_at ON file (changed_at);
+    '''
+
+    def __init__(self, fpath: Path | str) -> None:
+        self.conn = sqlite3.connect(fpath, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.executescript(self.schema)
+            columns = [
+                row[1]
+                for row in self.conn.execute('PRAGMA table_info(prefix)')
+            ]
+            if 'listed_from' not in columns:  # a cache of an older release
+                self.conn.execute(
+                    'ALTER TABLE prefix ADD COLUMN listed_from TEXT')
+        self.crawl_id: int | None = None
+        self.started_at: float = 0
+
+    def close(self):
+        self.conn.close()
+
+    def begin(self, prefix: str) -> float:
+        '''It resumes the unfinished crawl of `prefix` or starts a new one
+        '''
+        stmt = '''SELECT id, started_at FROM crawl
+                   WHERE prefix = ? AND finished_at IS NULL
+                   ORDER BY id DESC LIMIT 1'''
+        row = self.conn.execute(stmt, (prefix, )).fetchone()
+        if row:
+            self.crawl_id, self.started_at = row
+            logger.info(f'Resume the crawl of {prefix}')
+        else:
+            self.started_at = time.time()
+            with self.conn:
+                cursor = self.conn.execute(
+                    'INSERT INTO crawl (prefix, started_at) VALUES (?, ?)',
+                    (prefix, self.started_at))
+            self.crawl_id = cursor.lastrowid
+        return self.started_at
+
+    def finish(self):
+        with self.conn:
+            self.conn.execute('UPDATE crawl SET finished_at = ? WHERE id = ?',
+                              (time.time(), self.crawl_id))
+
+    def get(self, prefix: str) -> CachedPrefix | None:
+        stmt = '''SELECT prefix, listed_at, is_leaf, children, listed_from
+                    FROM prefix WHERE prefix = ?'''
+        row = self.conn.execute(stmt, (prefix, )).fetchone()
+        if not row:
+            return None
+        prefix, listed_at, is_leaf, children, listed_from = row
+        return CachedPrefix(prefix, listed_at, bool(is_leaf),
+                            json.loads(children), listed_from)
+
+    def get_start_after(self, prefix: str) -> str | None:
+        '''It returns the last key of the closed periods of a prefix
+        '''
+        stmt = 'SELECT key FROM file WHERE prefix = ? ORDER BY key DESC'
+        for key, in self.conn.execute(stmt, (prefix, )):
+            if is_closed(key):
+                return key
+        return None
+
+    def save(self,
+             prefix: str,
+             page: ListingPage,
+             base_url: str,
+             listed_from: str | None = ''):
+        '''It records a listing, a file is changed when it is new
+        or its size or etag differs from the cached one.
+        `listed_from` is the lowest key the files of the prefix are listed after
+        '''
+        stmt = '''
+        INSERT INTO file (key, prefix, size, last_modified, etag, changed_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            changed_at = CASE
+                WHEN excluded.size IS NOT file.size
+                  OR excluded.etag IS NOT file.etag
+                THEN excluded.changed_at ELSE file.changed_at END,
+            size = excluded.size,
+            last_modified = excluded.last_modified,
+            etag = excluded.etag
+        '''
+        now = time.time()
+        rows = [(a.url[len(base_url):], prefix, a.size, a.last_modified,
+                 a.etag, now) for a in page.files]
+        cached = self.get(prefix)
+        children = sorted(set(page.prefixes).union(
+            cached.children if cached else []))
+        with self.conn:
+            self.conn.executemany(stmt, rows)
+            self.conn.execute(
+                '''INSERT OR REPLACE INTO prefix
+                   (prefix, listed_at, is_leaf, children, listed_from)
+                   VALUES (?, ?, ?, ?, ?)''',
+                (prefix, now, int(not children), json.dumps(children),
+                 listed_from))
+
+    def changed(self, base_url: str, prefix: str = '') -> list[Artifact]:
+        '''It returns the files under `prefix` that are new or changed
+        in the current crawl
+        '''
+        stmt = '''SELECT key, size, last_modified, etag FROM file
+                   WHERE changed_at >= ? AND substr(key, 1, ?) = ?
+                   ORDER BY key'''
+        rows = self.conn.execute(stmt,
+                                 (self.started_at, len(prefix), prefix))
+        return [
+            Artifact(f'{base_url}{key}', size, last_modified, etag)
+            for key, size, last_modified, etag in rows
+        ]
+
+
+class ListingCrawler:
+    '''It pages through the bucket listing behind data.binance.vision
+    and walks the prefixes concurrently without a browser.
+
+    With a cache, a file-only prefix is listed after its last closed period,
+    or again from `start` when it was listed from a later month before,
+    and a prefix of prefixes is reused until it is older than `max_age`
+    '''
+
+    def __init__(self,
+                 base_url: str,
+                 listing_url: str = LISTING_URL,
+                 limit: int = 32,
+                 cache: ListingCache | None = None,
+                 max_age: float = 7 * 24 * 3600,
+                 prefix_filter: PrefixFilter | None = None) -> None:
+        self.base_url = base_url
+        self.listing_url = listing_url
+        self.limit = limit
+        self.cache = cache
+        self.max_age = max_age
+        self.prefix_filter = prefix_filter or PrefixFilter()
+        self.errors = 0
+
+    async def list_page(self,
+                        sess: aiohttp.ClientSession,
+                        prefix: str,
+                        token: str | None = None,
+                        start_after: str | None = None) -> ListingPage:
+        params = {'list-type': '2', 'delimiter': '/', 'prefix': prefix}
+        if token:
+            params['continuation-token'] = token
+        elif start_after:
+            params['start-after'] = start_after
+        async with sess.get(self.listing_url, params=params) as resp:
+            resp.raise_for_status()
+            text = await resp.text()
+        return ListingPage.from_xml(text, self.base_url)
+
+    async def list_prefix(self,
+                          sess: aiohttp.ClientSession,
+                          prefix: str,
+                          start_after: str | None = None) -> ListingPage:
+        '''It lists every page of a prefix
+        '''
+        logger.info(f'Crawl {prefix}')
+        output = ListingPage([], [])
+        token = None
+        while True:
+            page = await self.list_page(sess, prefix, token, start_after)
+            output.files.extend(page.files)
+            output.prefixes.extend(page.prefixes)
+            if not (token := page.token):
+                return output
+            if page.files and self.prefix_filter.is_over(page.files[-1].url):
+                return output
+
+    async def visit(self, sess: aiohttp.ClientSession, prefix: str,
+                    root: str) -> ListingPage:
+        start_after = self.prefix_filter.get_start_after(prefix)
+        if not self.cache:
+            return await self.list_prefix(sess, prefix, start_after)
+
+        cached = self.cache.get(prefix)
+        if cached and cached.listed_at >= self.cache.started_at:
+            return ListingPage([], cached.children)  # listed before a crash
+        if cached and not cached.is_leaf and prefix != root and \
+           time.time() - cached.listed_at < self.max_age:
+            return ListingPage([], cached.children)
+
+        listed_from = start_after or ''
+        if cached and cached.is_leaf and cached.covers(start_after):
+            listed_from = cached.listed_from
+            start_after = max(filter(None, [
+                start_after, self.cache.get_start_after(prefix)
+            ]), default=None)
+        page = await self.list_prefix(sess, prefix, start_after)
+        self.cache.save(prefix, page, self.base_url, listed_from)
+        return page
+
+    async def worker(self, sess: aiohttp.ClientSession,
+                     queue: asyncio.Queue[str], root: str,
+                     files: list[Artifact]):
+        while True:
+            prefix = await queue.get()
+            try:
+                page = await self.visit(sess, prefix, root)
+                files.extend(page.files)
+                for child in page.prefixes:
+                    if self.prefix_filter.match_prefix(root, child):
+                        queue.put_nowait(child)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f'{prefix} is failed: {e!r}')
+            finally:
+                queue.task_done()
+
+    async def crawl(self, prefix: str) -> list[Artifact]:
+        '''It crawls prefixes recursively until faces file download links,
+        only new or changed links are returned with a cache
+        '''
+        prefix = prefix.rstrip('/') + '/'
+        queue = asyncio.Queue()
+        queue.put_nowait(prefix)
+        files = []
+        if self.cache:
+            self.cache.begin(prefix)
+
+        connector = aiohttp.TCPConnector(limit=self.limit,
+                                         ttl_dns_cache=300)
+        async with aiohttp.ClientSession(connector=connector) as sess:
+            workers = [
+                asyncio.create_task(self.worker(sess, queue, prefix, files))
+                for _ in range(self.limit)
+            ]
+            await queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        if self.cache:
+            if self.errors:
+                logger.info(f'#{self.errors} prefixes are failed, '
+                            'the next crawl resumes this one')
+            else:
+                self.cache.finish()
+            files = self.cache.changed(self.base_url, prefix)
+        files = filter(lambda x: self.prefix_filter.match_file(x.url), files)
+        return sorted(files, key=lambda x: x.url)
@@ -0,0 +1,251 @@
+'''End-to-end benchmark of link_crawler, downloader, validator and kline_pusher
+
+It generates a synthetic corpus with tools/corpus.py, serves it with
+tools/stub_server.py and runs every tool as its own process on it, one stage
+after the other. Wall time, CPU time and peak RSS of each stage are taken from
+the rusage of its process. The report is JSON so two releases can be diffed,
+and `--baseline` fails when a stage is slower than a previous report.
+
+>>> python tools/benchmark.py -s BTCUSDT ETHUSDT -i 1m 1h -m 2023-01 2023-06 \
+        --output bench.json
+>>> python tools/benchmark.py ... --baseline bench.json --tolerance 0.2
+'''
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from corpus import PREFIX, INTERVAL_MS, generate, get_months
+
+ROOT = Path(__file__).resolve().parent.parent
+STUB_SERVER = ROOT / 'tools' / 'stub_server.py'
+# the kline tables of kline_pusher, one by timeframe
+KLINE_TABLES = [
+    'minute_1', 'minute_3', 'minute_5', 'minute_15', 'minute_30', 'hour_1',
+    'hour_2', 'hour_4', 'hour_6', 'hour_8', 'hour_12', 'day_1', 'day_3',
+    'week_1', 'month_1'
+]
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    until = time.monotonic() + timeout
+    while time.monotonic() < until:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'stub server is not up on {port}')
+
+
+def run_stage(cmd: list[str], cwd: Path, log_fpath: Path,
+              env: dict[str, str] | None = None) -> dict:
+    '''It runs a tool until it exits and returns the rusage of its process tree
+    '''
+    with open(log_fpath, mode='w') as log:
+        started_at = time.perf_counter()
+        proc = subprocess.Popen(cmd,
+                                cwd=cwd,
+                                env={
+                                    **os.environ, 'PYTHONPATH': str(ROOT),
+                                    **(env or {})
+                                },
+                                stdout=log,
+                                stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - started_at
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f'{cmd} exited with {proc.returncode}, '
+                           f'see {log_fpath}')
+    return {
+        'elapsed_sec': round(elapsed, 3),
+        'cpu_sec': round(rusage.ru_utime + rusage.ru_stime, 3),
+        'max_rss_mib': round(rusage.ru_maxrss / 1024, 1),  # KiB on linux
+    }
+
+
+def count_records(db_url: str) -> int | None:
+    if not db_url.startswith('sqlite:///'):
+        return None
+    with sqlite3.connect(db_url[len('sqlite:///'):]) as conn:
+        tables = [
+            row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")
+            if row[0] in KLINE_TABLES
+        ]
+        return sum(
+            conn.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0]
+            for table in tables)
+
+
+def add_rate(result: dict, name: str, value: float):
+    result[name] = round(value / result['elapsed_sec'], 1)
+
+
+def main(symbols: list[str],
+         intervals: list[str],
+         months: list[str],
+         db_url: str | None = None,
+         header: bool = False,
+         work_dir: Path | None = None,
+         keep: bool = False) -> dict:
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix='benchmark-'))
+    bucket_dir = work_dir / 'bucket'
+    download_dir, valid_dir = work_dir / 'download', work_dir / 'valid'
+    links_fpath = work_dir / 'links.csv'
+    db_url = db_url or f'sqlite:///{work_dir / "klines.db"}'
+    for dirpath in [download_dir, valid_dir]:
+        dirpath.mkdir(parents=True, exist_ok=True)
+
+    stats = generate(bucket_dir, symbols, intervals, get_months(*months),
+                     header=header)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus': {
+            'symbols': symbols,
+            'intervals': intervals,
+            'months': months,
+            **stats.asdict(),
+        },
+        'stages': {},
+    }
+    mib = stats.bytes / 2**20
+
+    port = get_free_port()
+    cmd = [sys.executable, str(STUB_SERVER), str(bucket_dir), '--port', str(port)]
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        url = f'http://127.0.0.1:{port}/'
+        stages = report['stages']
+
+        stages['crawl'] = run_stage([
+            sys.executable, 'main.py', '--base_url', url, '--listing_url', url,
+            '--prefix', PREFIX, '--link_fpath',
+            str(links_fpath)
+        ], ROOT / 'link_crawler', work_dir / 'crawl.log')
+        with open(links_fpath) as f:
+            n_links = sum(1 for line in f if line.strip())
+        stages['crawl']['links'] = n_links
+        add_rate(stages['crawl'], 'links_per_sec', n_links)
+
+        stages['download'] = run_stage([
+            sys.executable, 'main.py',
+            str(links_fpath), '--download_dir',
+            str(download_dir), '--valid_dir',
+            str(valid_dir)
+        ], ROOT / 'downloader', work_dir / 'download.log')
+        add_rate(stages['download'], 'mib_per_sec', mib)
+
+        stages['validate'] = run_stage([
+            sys.executable, 'main.py', '--download_dir',
+            str(download_dir), '--valid_dir',
+            str(valid_dir), '--threshold', '1'
+        ], ROOT / 'validator', work_dir / 'validate.log')
+        add_rate(stages['validate'], 'mib_per_sec', mib)
+
+        stages['push'] = run_stage(
+            [sys.executable, 'main.py',
+             str(valid_dir), '--env', os.devnull],
+            ROOT / 'kline_pusher',
+            work_dir / 'push.log',
+            env={'DB_URL': db_url})
+        records = count_records(db_url)
+        stages['push']['records'] = records
+        add_rate(stages['push'], 'records_per_sec', records or stats.records)
+    finally:
+        server.terminate()
+        server.wait()
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    '''It returns the stages whose wall or cpu time grew over `tolerance`
+    '''
+    regressions = []
+    for stage, result in report['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if not base:
+            continue
+        for name in ['elapsed_sec', 'cpu_sec']:
+            if base[name] and result[name] > base[name] * (1 + tolerance):
+                regressions.append(f'{stage}.{name}: {base[name]} -> '
+                                   f'{result[name]}')
+    return regressions
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='End-to-end benchmark on a synthetic corpus')
+    parser.add_argument('--symbols',
+                        '-s',
+                        nargs='+',
+                        default=['BTCUSDT', 'ETHUSDT'])
+    parser.add_argument('--intervals',
+                        '-i',
+                        nargs='+',
+                        default=['1m', '1h'],
+                        choices=[*INTERVAL_MS, '1mo'])
+    parser.add_argument('--months',
+                        '-m',
+                        nargs=2,
+                        default=['2023-01', '2023-03'],
+                        metavar=('FIRST', 'LAST'))
+    parser.add_argument('--header',
+                        action='store_true',
+                        help='archives with a header row')
+    parser.add_argument('--db_url',
+                        help='database of kline_pusher, '
+                        'e.g. mysql+pymysql://user:pw@127.0.0.1:3306/klines '
+                        '(a sqlite db in the work dir by default)')
+    parser.add_argument('--work_dir',
+                        type=Path,
+                        help='directory of the corpus and the outputs')
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='keep the work dir and the logs of the tools')
+    parser.add_argument('--output', '-o', type=Path, help='json report')
+    parser.add_argument('--baseline',
+                        type=Path,
+                        help='json report to compare with')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='ratio of slowdown accepted against the baseline')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    report = main(args.symbols, args.intervals, args.months, args.db_url,
+                  args.header, args.work_dir, args.keep)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, mode='w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,189 @@
+'''Synthetic Binance kline archives
+
+It writes monthly kline zips and their `.CHECKSUM` files in the layout of
+data.binance.vision, `<prefix>/<SYMBOL>/<interval>/<SYMBOL>-<interval>-<YYYY-MM>.zip`,
+with a random walk of prices, so every tool can be run on a known corpus.
+
+>>> python tools/corpus.py ./corpus -s BTCUSDT ETHUSDT -i 1m 1h -m 2023-01 2023-03
+'''
+from __future__ import annotations
+import argparse
+import calendar
+import dataclasses as dc
+import datetime as dt
+import hashlib
+import io
+import json
+import math
+import random
+import zipfile
+from pathlib import Path
+
+PREFIX = 'data/futures/um/monthly/klines'
+HEADER = ('open_time,open,high,low,close,volume,close_time,quote_volume,'
+          'count,taker_buy_volume,taker_buy_quote_volume,ignore')
+MINUTE = 60_000
+# milliseconds of the fixed intervals, `1w` and `1mo` are aligned to calendar
+INTERVAL_MS = {
+    '1m': MINUTE,
+    '3m': 3 * MINUTE,
+    '5m': 5 * MINUTE,
+    '15m': 15 * MINUTE,
+    '30m': 30 * MINUTE,
+    '1h': 60 * MINUTE,
+    '2h': 120 * MINUTE,
+    '4h': 240 * MINUTE,
+    '6h': 360 * MINUTE,
+    '8h': 480 * MINUTE,
+    '12h': 720 * MINUTE,
+    '1d': 1440 * MINUTE,
+    '3d': 3 * 1440 * MINUTE,
+    '1w': 7 * 1440 * MINUTE,
+}
+# 1970-01-05 is the first monday after the epoch
+WEEK_ORIGIN = 4 * 1440 * MINUTE
+
+
+def to_millis(date: dt.date) -> int:
+    return calendar.timegm(date.timetuple()) * 1000
+
+
+def get_months(first: str, last: str) -> list[dt.date]:
+    '''It returns the first days of the months from `first` to `last` (YYYY-MM)
+    '''
+    year, month = map(int, first.split('-'))
+    last_year, last_month = map(int, last.split('-'))
+    months = []
+    while (year, month) <= (last_year, last_month):
+        months.append(dt.date(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def get_opentimes(interval: str, month: dt.date) -> list[int]:
+    '''It returns the open times of the klines starting in a month
+    '''
+    start = to_millis(month)
+    days = calendar.monthrange(month.year, month.month)[1]
+    end = start + days * 1440 * MINUTE
+    if interval == '1mo':
+        return [start]
+    step = INTERVAL_MS[interval]
+    origin = WEEK_ORIGIN if interval == '1w' else 0
+    first = start + (origin - start) % step
+    return list(range(first, end, step))
+
+
+def get_closetime(interval: str, opentime: int) -> int:
+    if interval == '1mo':
+        date = dt.datetime.fromtimestamp(opentime / 1000, dt.timezone.utc)
+        days = calendar.monthrange(date.year, date.month)[1]
+        return opentime + days * 1440 * MINUTE - 1
+    return opentime + INTERVAL_MS[interval] - 1
+
+
+def render_klines(interval: str, opentimes: list[int], price: float,
+                  rng: random.Random, header: bool) -> tuple[str, float]:
+    '''It renders klines of a geometric random walk starting at `price`
+    and returns the csv with the last close
+    '''
+    step = INTERVAL_MS.get(interval, 30 * 1440 * MINUTE)
+    sigma = 0.0008 * math.sqrt(step / MINUTE)
+    lines = [HEADER] if header else []
+    for opentime in opentimes:
+        close = price * math.exp(rng.gauss(0, sigma))
+        high = max(price, close) * math.exp(abs(rng.gauss(0, sigma / 2)))
+        low = min(price, close) * math.exp(-abs(rng.gauss(0, sigma / 2)))
+        volume = rng.lognormvariate(0, 1) * step / MINUTE
+        quote_volume = volume * (price + close) / 2
+        trades = max(1, int(volume * rng.uniform(20, 60)))
+        taker = rng.uniform(0.3, 0.7)
+        lines.append(f'{opentime},{price:.2f},{high:.2f},{low:.2f},{close:.2f},'
+                     f'{volume:.3f},{get_closetime(interval, opentime)},'
+                     f'{quote_volume:.5f},{trades},{volume * taker:.3f},'
+                     f'{quote_volume * taker:.5f},0')
+        price = close
+    return '\n'.join(lines) + '\n', price
+
+
+@dc.dataclass
+class CorpusStats:
+    files: int = 0
+    bytes: int = 0
+    records: int = 0
+    keys: list[str] = dc.field(default_factory=list)
+
+    def asdict(self) -> dict:
+        return {'files': self.files, 'bytes': self.bytes, 'records': self.records}
+
+
+def generate(root: Path,
+             symbols: list[str],
+             intervals: list[str],
+             months: list[dt.date],
+             prefix: str = PREFIX,
+             header: bool = False,
+             seed: int = 0) -> CorpusStats:
+    stats = CorpusStats()
+    for symbol in symbols:
+        rng = random.Random(f'{seed}:{symbol}')
+        for interval in intervals:
+            price = rng.uniform(1, 50000)
+            for month in months:
+                name = f'{symbol}-{interval}-{month:%Y-%m}'
+                key = f'{prefix}/{symbol}/{interval}/{name}.zip'
+                fpath = Path(root, key)
+                fpath.parent.mkdir(parents=True, exist_ok=True)
+
+                opentimes = get_opentimes(interval, month)
+                text, price = render_klines(interval, opentimes, price, rng,
+                                            header)
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, mode='w',
+                                     compression=zipfile.ZIP_DEFLATED) as zf:
+                    zf.writestr(f'{name}.csv', text)
+                data = buffer.getvalue()
+                fpath.write_bytes(data)
+                checksum = hashlib.sha256(data).hexdigest()
+                Path(f'{fpath}.CHECKSUM').write_text(f'{checksum}  {fpath.name}\n')
+
+                stats.files += 1
+                stats.bytes += len(data)
+                stats.records += len(opentimes)
+                stats.keys.append(key)
+    return stats
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic Binance kline archives')
+    parser.add_argument('root', type=Path, help='directory of the corpus')
+    parser.add_argument('--symbols',
+                        '-s',
+                        nargs='+',
+                        default=['BTCUSDT', 'ETHUSDT'])
+    parser.add_argument('--intervals',
+                        '-i',
+                        nargs='+',
+                        default=['1m', '1h'],
+                        choices=[*INTERVAL_MS, '1mo'])
+    parser.add_argument('--months',
+                        '-m',
+                        nargs=2,
+                        default=['2023-01', '2023-03'],
+                        metavar=('FIRST', 'LAST'),
+                        help='the first and the last month (YYYY-MM)')
+    parser.add_argument('--prefix', '-p', default=PREFIX)
+    parser.add_argument('--header',
+                        action='store_true',
+                        help='write a header row as the newer archives do')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    stats = generate(args.root, args.symbols, args.intervals,
+                     get_months(*args.months), args.prefix, args.header,
+                     args.seed)
+    print(json.dumps(stats.asdict()))
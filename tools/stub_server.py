@@ -0,0 +1,248 @@
+'''Local stand-in for data.binance.vision
+
+It serves a directory as a bucket, `GET /?list-type=2&prefix=...` answers
+a `ListObjectsV2` listing and `GET /<key>` answers the file with `Range` support.
+Throttling, server errors, dropped connections and latency can be injected.
+
+>>> python tools/stub_server.py ./corpus --port 8000
+>>> python link_crawler/main.py --base_url http://127.0.0.1:8000/ \
+        --listing_url http://127.0.0.1:8000/ --prefix data/futures/um/monthly/klines
+'''
+from __future__ import annotations
+import argparse
+import dataclasses as dc
+import email.utils
+import hashlib
+import os
+import random
+import re
+import time
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+import datetime as dt
+
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+CHUNK_SIZE = 2**20
+
+
+def list_keys(root: Path, prefix: str, delimiter: str) -> list[tuple[str, bool]]:
+    '''It returns sorted `(key, is_prefix)` under `prefix`
+    '''
+    dirname, _, basename = prefix.rpartition('/')
+    dirpath = Path(root, dirname)
+    if not dirpath.is_dir():
+        return []
+
+    keys = []
+    if delimiter == '/':
+        for entry in os.scandir(dirpath):
+            if not entry.name.startswith(basename):
+                continue
+            key = f'{dirname}/{entry.name}' if dirname else entry.name
+            is_dir = entry.is_dir()
+            keys.append((key + '/' if is_dir else key, is_dir))
+    else:
+        for path, _, fnames in os.walk(dirpath):
+            for fname in fnames:
+                key = Path(path, fname).relative_to(root).as_posix()
+                if key.startswith(prefix):
+                    keys.append((key, False))
+    return sorted(keys)
+
+
+def to_isoformat(timestamp: float) -> str:
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc)\
+                      .strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def get_etag(fpath: Path) -> str:
+    stat = fpath.stat()
+    tag = f'{fpath}:{stat.st_size}:{stat.st_mtime_ns}'.encode()
+    return hashlib.md5(tag).hexdigest()
+
+
+@dc.dataclass
+class Faults:
+    throttle_rate: float = 0  # 429 with `Retry-After`
+    retry_after: int = 1
+    error_rate: float = 0  # 503
+    drop_rate: float = 0  # the connection is closed in the middle of a body
+    latency: float = 0  # seconds before a response
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, root: Path, max_keys: int, faults: Faults,
+                 **kwargs) -> None:
+        self.root = root
+        self.max_keys = max_keys
+        self.faults = faults
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def do_GET(self):
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+        if random.random() < self.faults.throttle_rate:
+            headers = {'Retry-After': str(self.faults.retry_after)}
+            return self.send_body(429, b'', headers)
+        if random.random() < self.faults.error_rate:
+            return self.send_body(503, b'', {})
+
+        url = urlparse(self.path)
+        key = unquote(url.path.lstrip('/'))
+        if not key:
+            return self.send_listing(parse_qs(url.query))
+        return self.send_file(key)
+
+    def send_body(self, status: int, body: bytes, headers: dict[str, str]):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_listing(self, query: dict[str, list[str]]):
+        param = lambda name, default='': query.get(name, [default])[0]
+        prefix = param('prefix')
+        delimiter = param('delimiter')
+        start = param('continuation-token') or param('marker') or \
+                param('start-after')
+        max_keys = min(int(param('max-keys', self.max_keys)), self.max_keys)
+
+        keys = [x for x in list_keys(self.root, prefix, delimiter)
+                if x[0] > start]
+        page, is_truncated = keys[:max_keys], len(keys) > max_keys
+
+        nodes = []
+        for key, is_prefix in page:
+            if is_prefix:
+                nodes.append('<CommonPrefixes>'
+                             f'<Prefix>{escape(key)}</Prefix>'
+                             '</CommonPrefixes>')
+                continue
+            fpath = Path(self.root, key)
+            stat = fpath.stat()
+            nodes.append('<Contents>'
+                         f'<Key>{escape(key)}</Key>'
+                         f'<LastModified>{to_isoformat(stat.st_mtime)}</LastModified>'
+                         f'<ETag>"{get_etag(fpath)}"</ETag>'
+                         f'<Size>{stat.st_size}</Size>'
+                         '<StorageClass>STANDARD</StorageClass>'
+                         '</Contents>')
+        token = ''
+        if is_truncated:
+            token = f'<NextContinuationToken>{escape(page[-1][0])}'\
+                    '</NextContinuationToken>'
+
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                f'<ListBucketResult xmlns="{S3_XMLNS}">'
+                f'<Prefix>{escape(prefix)}</Prefix>'
+                f'<KeyCount>{len(page)}</KeyCount>'
+                f'<MaxKeys>{max_keys}</MaxKeys>'
+                f'<Delimiter>{escape(delimiter)}</Delimiter>'
+                f'<IsTruncated>{str(is_truncated).lower()}</IsTruncated>'
+                f'{token}{"".join(nodes)}'
+                '</ListBucketResult>')
+        self.send_body(200, body.encode(), {'Content-Type': 'application/xml'})
+
+    def send_file(self, key: str):
+        fpath = Path(self.root, key)
+        if not fpath.is_file():
+            return self.send_body(404, b'', {})
+
+        size = fpath.stat().st_size
+        headers = {
+            'Content-Type': 'application/zip',
+            'Accept-Ranges': 'bytes',
+            'ETag': f'"{get_etag(fpath)}"',
+            'Last-Modified': email.utils.formatdate(fpath.stat().st_mtime,
+                                                    usegmt=True),
+        }
+        start, status = 0, 200
+        if match := re.match(r'bytes=(\d+)-', self.headers.get('Range', '')):
+            start, status = int(match.group(1)), 206
+            if start >= size:
+                headers['Content-Range'] = f'bytes */{size}'
+                return self.send_body(416, b'', headers)
+            headers['Content-Range'] = f'bytes {start}-{size - 1}/{size}'
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        drop_at = size
+        if random.random() < self.faults.drop_rate:
+            drop_at = random.randint(start, size)
+        with open(fpath, mode='rb') as f:
+            f.seek(start)
+            while f.tell() < drop_at:
+                data = f.read(min(CHUNK_SIZE, drop_at - f.tell()))
+                self.wfile.write(data)
+        if drop_at < size:
+            self.close_connection = True
+
+
+def create_server(root: Path,
+                  host: str = '127.0.0.1',
+                  port: int = 8000,
+                  max_keys: int = 1000,
+                  faults: Faults | None = None) -> ThreadingHTTPServer:
+    handler = partial(StubHandler,
+                      root=Path(root),
+                      max_keys=max_keys,
+                      faults=faults or Faults())
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for data.binance.vision')
+    parser.add_argument('root', type=Path, help='directory served as a bucket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', '-p', type=int, default=8000)
+    parser.add_argument('--max_keys',
+                        type=int,
+                        default=1000,
+                        help='the number of maximum keys of a listing page')
+    parser.add_argument('--throttle_rate',
+                        type=float,
+                        default=0,
+                        help='ratio of requests answered 429 with Retry-After')
+    parser.add_argument('--retry_after', type=int, default=1)
+    parser.add_argument('--error_rate',
+                        type=float,
+                        default=0,
+                        help='ratio of requests answered 503')
+    parser.add_argument('--drop_rate',
+                        type=float,
+                        default=0,
+                        help='ratio of downloads cut off in the middle')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0,
+                        help='seconds before every response')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    faults = Faults(args.throttle_rate, args.retry_after, args.error_rate,
+                    args.drop_rate, args.latency)
+    server = create_server(args.root, args.host, args.port, args.max_keys,
+                           faults)
+    print(f'Serve {args.root} at http://{args.host}:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,8 +1,10 @@
 import time
 import os
 import argparse
-import platform
 import asyncio
+import hashlib
+import mmap
+from concurrent.futures import Executor, ThreadPoolExecutor
 from pathlib import Path, PurePath
 import logging
 import logging.config
@@ -10,6 +12,13 @@ import logging.config
 import aiofiles
 import aiofiles.os
 
+from common.manifest import Manifest, Status
+
+try:
+    from watchdog.observers import Observer
+except ImportError:  # the download dir is polled instead
+    Observer = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
@@ -17,27 +26,43 @@ logger = logging.getLogger()
 def split_files(dirpath: Path) -> tuple[set[str], set[str]]:
     files = set(os.listdir(dirpath))
     checksums = set([f for f in files if f.endswith('CHECKSUM')])
-    zipfiles = files - checksums
+    zipfiles = set([f for f in files - checksums if not f.endswith('.part')])
     return checksums, zipfiles
 
 
+def stat_files(dirpath: Path) -> set[tuple[str, int, int]]:
+    '''It lists the name, the mtime (ns) and the size of each file'''
+    stats = set()
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            stats.add((entry.name, stat.st_mtime_ns, stat.st_size))
+    return stats
+
+
 async def read_checksum(fpath: Path) -> tuple[str, str]:
     async with aiofiles.open(fpath, mode='r') as f:
         resp = await f.read()
     return tuple(resp.split())
 
 
-async def get_checksum(fpath: Path) -> str:
-    cmd = 'shasum -a 256' if platform.mac_ver else 'sha256sum'
-    cmd += f' {fpath}'
-    proc = await asyncio.create_subprocess_shell(cmd,
-                                                 stdout=asyncio.subprocess.PIPE,
-                                                 stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await proc.communicate()
-    if stdout:
-        return str(stdout.split()[0], 'utf-8')
-    if stderr:
-        return str(stderr, 'utf-8')
+def sha256sum(fpath: Path) -> str:
+    '''It hashes a memory-mapped file, hashlib releases the GIL while hashing
+    so a thread pool runs it on every core
+    '''
+    with open(fpath, mode='rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:  # an empty file can't be mapped
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha256(mm).hexdigest()
+
+
+async def get_checksum(executor: Executor, fpath: Path) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, sha256sum, fpath)
 
 
 async def move_validfile(fpath: Path, valid_dirpath: Path):
@@ -47,15 +72,18 @@ async def move_validfile(fpath: Path, valid_dirpath: Path):
 
 async def remove_failed(download_dirpath: Path,
                         failed: dict[str, int],
-                        threshold: int = 3):
+                        threshold: int = 3,
+                        manifest: Manifest | None = None):
     for fname, cnt in failed.items():
         if cnt >= threshold:
             fpath = Path(os.path.join(download_dirpath, fname))
             await aiofiles.os.remove(fpath)
+            if manifest:
+                manifest.update_by_fname(fname, Status.FAILED)
             logger.info(f'{fname} is invalid, removed')
 
 
-async def validate(download_dir: Path, valid_dir: Path, failed: dict[str, int]):
+def list_checksums(download_dir: Path, valid_dir: Path) -> list[Path]:
     checksums, zipfiles = split_files(download_dir)
     valid_zipfiles = set(os.listdir(valid_dir))
     msg = f'#{len(checksums)} checksums / ' + \
@@ -63,36 +91,223 @@ async def validate(download_dir: Path, valid_dir: Path, failed: dict[str, int]):
           f'#{len(valid_zipfiles)} valid zipfiles'
     logger.info(msg)
     if not zipfiles:
-        return
+        return []
 
+    fpaths = []
     for checksum_fname in checksums:
         if PurePath(checksum_fname).stem in valid_zipfiles:
             continue
-
-        checksum_fpath = Path(os.path.join(download_dir, checksum_fname))
-        hash, zipfname = await read_checksum(checksum_fpath)
-        if zipfname not in zipfiles:  # it's already validated
+        if PurePath(checksum_fname).stem not in zipfiles:
             continue
+        fpaths.append(Path(os.path.join(download_dir, checksum_fname)))
+    return fpaths
 
-        zipfpath = Path(os.path.join(download_dir, zipfname))
-        checksum = await get_checksum(zipfpath)
-        if hash == checksum:
-            await move_validfile(zipfpath, valid_dir)
-            logger.info(f'{zipfname} is valid')
-        else:
-            cnt = failed[zipfname] if zipfname in failed else 0
-            cnt += 1
-            failed.update({zipfname: cnt})
-            logger.info(f'{zipfname} is failed {hash}/{checksum}')
 
+def list_manifest_checksums(download_dir: Path,
+                            manifest: Manifest) -> list[Path]:
+    '''It looks up downloaded zipfiles in the manifest instead of the dirs
+    '''
+    artifacts = manifest.select(Status.DOWNLOADED)
+    fnames = set([artifact.fname for artifact in artifacts])
+    zipfnames = [f for f in fnames if not f.endswith('CHECKSUM')]
+    logger.info(f'#{len(zipfnames)} downloaded zipfiles')
+
+    fpaths = []
+    for zipfname in zipfnames:
+        checksum_fname = f'{zipfname}.CHECKSUM'
+        if checksum_fname in fnames:
+            fpaths.append(Path(os.path.join(download_dir, checksum_fname)))
+    return fpaths
 
-async def main(download_dir: Path, valid_dir: Path, threshold: int):
+
+async def validate(executor: Executor,
+                   download_dir: Path,
+                   valid_dir: Path,
+                   failed: dict[str, int],
+                   manifest: Manifest | None = None):
+    if manifest:
+        checksum_fpaths = list_manifest_checksums(download_dir, manifest)
+    else:
+        checksum_fpaths = list_checksums(download_dir, valid_dir)
+    hashes = await asyncio.gather(*map(read_checksum, checksum_fpaths))
+
+    jobs = []
+    for hash, zipfname in hashes:
+        jobs.append(validate_file(executor, download_dir, valid_dir, zipfname,
+                                  hash, failed, manifest))
+    await asyncio.gather(*jobs)
+
+
+async def validate_file(executor: Executor,
+                        download_dir: Path,
+                        valid_dir: Path,
+                        zipfname: str,
+                        hash: str,
+                        failed: dict[str, int],
+                        manifest: Manifest | None = None):
+    zipfpath = Path(os.path.join(download_dir, zipfname))
+    checksum = await get_checksum(executor, zipfpath)
+    if hash == checksum:
+        await move_validfile(zipfpath, valid_dir)
+        if manifest:
+            valid_fpath = os.path.join(valid_dir, zipfname)
+            manifest.update_by_fname(zipfname, Status.VALID,
+                                     fpath=valid_fpath, sha256=hash)
+        logger.info(f'{zipfname} is valid')
+    else:
+        cnt = failed[zipfname] if zipfname in failed else 0
+        cnt += 1
+        failed.update({zipfname: cnt})
+        if manifest:
+            manifest.update_by_fname(zipfname, Status.DOWNLOADED,
+                                     failure=True, sha256=hash)
+        logger.info(f'{zipfname} is failed {hash}/{checksum}')
+
+
+async def main(download_dir: Path,
+               valid_dir: Path,
+               threshold: int,
+               workers: int | None = None,
+               manifest: Manifest | None = None):
     failed = {}
-    for _ in range(threshold):
-        await validate(download_dir, valid_dir, failed)
-        time.sleep(5)
+    with ThreadPoolExecutor(workers) as executor:
+        for idx in range(threshold):
+            await validate(executor, download_dir, valid_dir, failed,
+                           manifest)
+            if idx < threshold - 1:
+                await asyncio.sleep(5)
     logger.info(f'Fails: {failed}')
-    await remove_failed(download_dir, failed, threshold)
+    await remove_failed(download_dir, failed, threshold, manifest)
+
+
+class EventHandler:
+    '''It passes the names of files completed in a watched dir to the event loop,
+    the downloader renames `.part` files so a finished file is a `moved` event
+    '''
+    event_types = {'moved', 'closed'}
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 queue: asyncio.Queue[str]) -> None:
+        self.loop = loop
+        self.queue = queue
+
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in self.event_types:
+            return
+        fpath = getattr(event, 'dest_path', '') or event.src_path
+        fname = os.path.basename(os.fsdecode(fpath))
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, fname)
+
+
+class Watcher:
+    '''It validates each zipfile once, as soon as the zipfile and
+    its checksum are both in the download dir
+    '''
+
+    def __init__(self,
+                 executor: Executor,
+                 download_dir: Path,
+                 valid_dir: Path,
+                 manifest: Manifest | None = None) -> None:
+        self.executor = executor
+        self.download_dir = download_dir
+        self.valid_dir = valid_dir
+        self.manifest = manifest
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        # checksum of a zipfile not valid yet, kept until it validates so
+        # a zipfile downloaded again is matched without a checksum event
+        self.hashes: dict[str, str] = {}
+        self.zipfiles: set[str] = set()  # zipfile waiting for its checksum
+        self.validating: set[str] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+    async def handle(self, fname: str):
+        fpath = Path(os.path.join(self.download_dir, fname))
+        if fname.endswith('.part') or not await aiofiles.os.path.exists(fpath):
+            return
+
+        if fname.endswith('CHECKSUM'):
+            hash, zipfname = await read_checksum(fpath)
+            valid_fpath = Path(os.path.join(self.valid_dir, zipfname))
+            if await aiofiles.os.path.exists(valid_fpath):
+                return
+            self.hashes[zipfname] = hash
+        else:
+            zipfname = fname
+            self.zipfiles.add(zipfname)
+
+        if zipfname in self.validating:  # e.g. `moved` then `closed`
+            self.zipfiles.discard(zipfname)
+            return
+        if zipfname in self.hashes and zipfname in self.zipfiles:
+            self.zipfiles.remove(zipfname)
+            self.validating.add(zipfname)
+            task = asyncio.create_task(
+                self.validate(zipfname, self.hashes[zipfname]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def validate(self, zipfname: str, hash: str):
+        '''A complete zipfile is validated once, so a failed one is removed
+        at once to be downloaded again and validated by the same checksum
+        '''
+        failed = {}
+        try:
+            await validate_file(self.executor, self.download_dir,
+                                self.valid_dir, zipfname, hash, failed,
+                                self.manifest)
+            await remove_failed(self.download_dir, failed, 1, self.manifest)
+            if zipfname not in failed:
+                self.hashes.pop(zipfname, None)
+        except FileNotFoundError:
+            logger.info(f'{zipfname} is gone before validation')
+        finally:
+            self.validating.discard(zipfname)
+
+    async def poll(self, interval: float):
+        '''A file is queued again when its mtime or size changes, e.g. a
+        zipfile removed and downloaded again under the same name
+        '''
+        seen = set()
+        while True:
+            stats = await asyncio.to_thread(stat_files, self.download_dir)
+            for fname in {fname for fname, *_ in stats - seen}:
+                self.queue.put_nowait(fname)
+            seen = stats
+            await asyncio.sleep(interval)
+
+    async def run(self, interval: float = 5):
+        if Observer:
+            handler = EventHandler(asyncio.get_running_loop(), self.queue)
+            observer = Observer()
+            observer.schedule(handler, str(self.download_dir))
+            observer.start()
+            for fname in await aiofiles.os.listdir(self.download_dir):
+                self.queue.put_nowait(fname)
+            logger.info(f'Watch {self.download_dir}')
+        else:
+            poller = asyncio.create_task(self.poll(interval))
+            logger.info(f'Poll {self.download_dir} every {interval} sec')
+
+        try:
+            while True:
+                await self.handle(await self.queue.get())
+        finally:
+            if Observer:
+                observer.stop()
+                observer.join()
+            else:
+                poller.cancel()
+
+
+async def watch(download_dir: Path,
+                valid_dir: Path,
+                interval: float,
+                workers: int | None = None,
+                manifest: Manifest | None = None):
+    with ThreadPoolExecutor(workers) as executor:
+        watcher = Watcher(executor, download_dir, valid_dir, manifest)
+        await watcher.run(interval)
 
 
 def get_args() -> argparse.Namespace:
@@ -100,6 +315,23 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('--download_dir', '-d', type=Path, required=True)
     parser.add_argument('--valid_dir', '-v', type=Path, required=True)
     parser.add_argument('--threshold', '-t', type=int, default=3)
+    parser.add_argument('--workers',
+                        '-w',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='the number of files hashed at once')
+    parser.add_argument('--manifest',
+                        '-m',
+                        type=Path,
+                        help='artifact manifest db shared with the other tools')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='validate files as soon as they are downloaded')
+    parser.add_argument('--interval',
+                        type=float,
+                        default=5,
+                        help='poll interval when filesystem events are not '
+                        'available')
     return parser.parse_args()
 
 
@@ -109,9 +341,20 @@ if __name__ == "__main__":
        not os.path.exists(args.valid_dir):
         raise ValueError('Invalid Dirs')
 
+    manifest = Manifest(args.manifest) if args.manifest else None
     try:
         t1 = time.time()
-        asyncio.run(main(args.download_dir, args.valid_dir, args.threshold))
+        if args.watch:
+            asyncio.run(
+                watch(args.download_dir, args.valid_dir, args.interval,
+                      args.workers, manifest))
+        else:
+            asyncio.run(
+                main(args.download_dir, args.valid_dir, args.threshold,
+                     args.workers, manifest))
         print(f'{time.time() - t1:.2f} sec')
     except:
         logger.info('===== FINISH =====')
+    finally:
+        if manifest:
+            manifest.close()